@@ -1,63 +1,146 @@
 import asyncio
-import os
-from tempfile import NamedTemporaryFile
+import io
+import random
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import BadRequest, Forbidden, TooManyRequests
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 
+from .concurrency import get_controller
+from .digests import get_digest_store, get_slice_digests
+from .metrics import metrics
 from .table_metadata import metric_data
 
+STAGING_TABLE_EXPIRATION = timedelta(hours=1)
+# Error reasons BigQuery reports for quota and rate limit violations
+QUOTA_REASONS = {"quotaExceeded", "rateLimitExceeded", "jobRateLimitExceeded"}
+# Reported by DML jobs that conflict with another one updating the same table
+CONCURRENT_UPDATE_MESSAGE = "due to concurrent update"
+# Passed in place of a measure for the wide table holding every measure of a
+# dimension, one nullable column each
+ALL_MEASURES = "all"
+
+ARROW_TYPES = {
+    "DATE": pa.date32(),
+    "STRING": pa.string(),
+    "INT64": pa.int64(),
+    "FLOAT64": pa.float64(),
+}
+
 
 class BigqueryClient:
+    max_job_retries = 5
+    job_backoff_base = 1.0
+    job_backoff_max = 60.0
+
+    # Shared by every BigqueryClient in the process so that each table is
+    # checked or created at most once per run
+    _clients = {}
+    _known_datasets = set()
+    _known_tables = set()
+    _lock = threading.Lock()
+    _key_locks = defaultdict(threading.Lock)
+
     def __init__(self, dataset, project):
         self.dataset = dataset
         self.project = project
-        # bigquery has a 100 concurrent request limit per method per user
-        self.load_semaphore = asyncio.Semaphore(50)
+        self.bq_client = self.get_client(project)
 
-    @staticmethod
-    async def create_client(project_id, dataset_id):
-        bq_client = bigquery.Client(project=project_id)
+    @classmethod
+    def get_client(cls, project):
+        with cls._lock:
+            if project not in cls._clients:
+                cls._clients[project] = bigquery.Client(project=project)
+            return cls._clients[project]
+
+    @classmethod
+    def invalidate(cls, fqid):
+        with cls._lock:
+            cls._known_datasets.discard(fqid)
+            cls._known_tables.discard(fqid)
+
+    @classmethod
+    def ensure_exists(cls, known, fqid, get, create):
+        if fqid in known:
+            metrics.incr("bigquery_metadata_cache_hits")
+            return
+
+        # Serialize checks per dataset or table so that concurrent exports
+        # share one round trip instead of racing to create it
+        with cls._lock:
+            key_lock = cls._key_locks[fqid]
+
+        with key_lock:
+            if fqid in known:
+                return
+            try:
+                get()
+                print("{} already exists".format(fqid))
+            except NotFound:
+                print("{} is not found".format(fqid))
+                create()
+                print("Created {}".format(fqid))
+            metrics.incr("bigquery_metadata_cache_misses")
+            with cls._lock:
+                known.add(fqid)
+
+    @classmethod
+    async def create_client(cls, project_id, dataset_id):
+        bq_client = cls.get_client(project_id)
 
         dataset = bq_client.dataset(dataset_id)
 
-        try:
-            bq_client.get_dataset(dataset_id)
-            print("Dataset {} already exists".format(dataset_id))
-        except NotFound:
-            print("Dataset {} is not found".format(dataset_id))
-            bq_client.create_dataset(dataset)
+        await asyncio.to_thread(
+            cls.ensure_exists,
+            cls._known_datasets,
+            str(dataset),
+            lambda: bq_client.get_dataset(dataset),
+            lambda: bq_client.create_dataset(dataset, exists_ok=True),
+        )
 
-        return BigqueryClient(dataset, project_id)
+        return cls(dataset, project_id)
 
     async def create_table_if_not_exists(self, measure, dimension):
         table_name = BigqueryClient.get_table_name(measure, dimension)
         table_fqid = f"{self.dataset}.{table_name}"
 
         schema = BigqueryClient.get_schema(measure, dimension)
-        description = metric_data[measure]["description"]
-
-        table = self.dataset.table(table_name)
+        if measure == ALL_MEASURES:
+            description = f"Every App Store metric by {dimension or 'app'}"
+        else:
+            description = metric_data[measure]["description"]
 
-        bq_client = bigquery.Client(project=self.project)
-
-        try:
-            bq_client.get_table(table_fqid)  # Make an API request.
-            print("Table {} already exists.".format(table_name))
-            return table
-        except NotFound:
-            print("Table {} is not found.".format(table_name))
+        def create():
             table = bigquery.Table(table_fqid, schema=schema)
             table.description = description
             table.time_partitioning = bigquery.TimePartitioning(
                 type_=bigquery.TimePartitioningType.DAY, field="date"
             )
-            table = bq_client.create_table(table)
-            print(f"Created table {table.table_id}")
-            return table
+            if measure == ALL_MEASURES:
+                table.clustering_fields = ["app_name", dimension] if dimension else None
+            self.bq_client.create_table(table, exists_ok=True)
+
+        await asyncio.to_thread(
+            self.ensure_exists,
+            self._known_tables,
+            table_fqid,
+            lambda: self.bq_client.get_table(table_fqid),
+            create,
+        )
+
+        return self.dataset.table(table_name)
 
     @staticmethod
     def get_table_name(measure, dimension):
+        if measure == ALL_MEASURES:
+            return f"all_metrics_by_{dimension}" if dimension else "all_metrics_total"
+
         optin = "opt_in_" if metric_data[measure]["optin"] else ""
         return (
             f"{metric_data[measure]['name']}_by_{optin}" f"{dimension}"
@@ -65,8 +148,18 @@ class BigqueryClient:
             else f"{metric_data[measure]['name']}_total"
         )
 
+    @staticmethod
+    def get_column_name(measure):
+        # Column of a measure in the wide table, marking opt-in measures like
+        # their table names do
+        optin = "_opt_in" if metric_data[measure]["optin"] else ""
+        return f"{metric_data[measure]['name']}{optin}"
+
     @staticmethod
     def get_schema(measure, dimension):
+        if measure == ALL_MEASURES:
+            return BigqueryClient.get_wide_schema(dimension)
+
         schema = [
             bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
             bigquery.SchemaField("app_name", "STRING", mode="REQUIRED"),
@@ -82,50 +175,263 @@ class BigqueryClient:
 
         return schema
 
-    async def write_data(self, app_name, measure, dimension, date, data, overwrite):
-        bq_client = bigquery.Client(project=self.project)
+    @staticmethod
+    def get_wide_schema(dimension):
+        schema = [
+            bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
+            bigquery.SchemaField("app_name", "STRING", mode="REQUIRED"),
+        ]
 
-        schema = BigqueryClient.get_schema(measure, dimension)
-        table_name = BigqueryClient.get_table_name(measure, dimension)
-        table_fqid = f"{self.dataset}.{table_name}"
+        if dimension:
+            schema.append(bigquery.SchemaField(dimension, "STRING", mode="REQUIRED"))
 
-        csv_data = [
-            "\t".join(
-                [entry["date"], app_name, str(entry["metric"]), entry["dimension"]]
+        # A row only has values for the measures reported for its dimension value
+        for measure, data in metric_data.items():
+            schema.append(
+                bigquery.SchemaField(
+                    BigqueryClient.get_column_name(measure),
+                    data["type"],
+                    mode="NULLABLE",
+                    description=data["description"],
+                )
             )
-            for entry in data
-        ]
-        with NamedTemporaryFile(mode="w+", delete=False) as temp_file:
-            temp_file.write("\n".join(csv_data))
-
-        # Write to correct date partition
-        # table = self.dataset.table(f"{table_fqid}${date.replace('-', '')}")
-
-        async with self.load_semaphore:
-            bq_client.query(
-                (
-                    f"DELETE FROM {table_fqid} "
-                    f"WHERE date = '{date}' "
-                    f"AND app_name = '{app_name}'"
+
+        return schema
+
+    @staticmethod
+    def get_arrow_schema(measure, dimension):
+        return pa.schema(
+            [
+                pa.field(
+                    field.name,
+                    ARROW_TYPES[field.field_type],
+                    nullable=field.mode != "REQUIRED",
                 )
+                for field in BigqueryClient.get_schema(measure, dimension)
+            ]
+        )
+
+    @staticmethod
+    def to_wide_table(tables: dict, dimension) -> pa.Table:
+        """
+        Join the Arrow tables of several measures of a dimension, keyed by
+        measure, into a table with the columns of `get_wide_schema`
+        """
+        keys = ["date", "app_name"] + ([dimension] if dimension else [])
+        schema = BigqueryClient.get_arrow_schema(ALL_MEASURES, dimension)
+
+        wide = None
+        for measure, table in tables.items():
+            table = table.rename_columns(
+                [
+                    BigqueryClient.get_column_name(measure)
+                    if name == metric_data[measure]["name"]
+                    else name
+                    for name in table.column_names
+                ]
             )
+            wide = (
+                table
+                if wide is None
+                else wide.join(table, keys, join_type="full outer")
+            )
+
+        num_rows = wide.num_rows if wide is not None else 0
+        columns = [
+            wide[field.name].cast(field.type)
+            if wide is not None and field.name in wide.column_names
+            else pa.nulls(num_rows, field.type)
+            for field in schema
+        ]
+        return pa.Table.from_arrays(columns, schema=schema)
+
+    @staticmethod
+    def to_parquet(table):
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer)
+        buffer.seek(0)
+        return buffer
+
+    async def load_table(self, bq_client, destination, schema, table):
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            create_disposition=bigquery.CreateDisposition.CREATE_NEVER,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            schema=schema,
+        )
 
-            job_config = bigquery.LoadJobConfig(
-                source_format=bigquery.SourceFormat.CSV,
-                create_disposition=bigquery.CreateDisposition.CREATE_NEVER,
-                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
-                if overwrite
-                else bigquery.WriteDisposition.WRITE_APPEND,
-                field_delimiter="\t",
-                schema=schema,
+        with metrics.timer("parquet_serialize"):
+            buffer = await asyncio.to_thread(BigqueryClient.to_parquet, table)
+        metrics.incr("rows_serialized", table.num_rows)
+        metrics.incr("bytes_serialized", buffer.getbuffer().nbytes)
+
+        def submit():
+            buffer.seek(0)
+            return bq_client.load_table_from_file(
+                buffer,
+                destination,
+                job_config=job_config,
             )
 
-            with open(temp_file.name, "rb") as source_file:
-                job = bq_client.load_table_from_file(
-                    source_file, table_fqid, job_config=job_config
-                )
+        with metrics.timer("bigquery_load_job"):
+            await self.run_job(get_controller().bigquery_load, submit)
+        metrics.incr("bigquery_load_jobs")
+
+    @staticmethod
+    def is_quota_error(error):
+        if isinstance(error, TooManyRequests):
+            return True
+        return isinstance(error, Forbidden) and any(
+            e.get("reason") in QUOTA_REASONS for e in error.errors
+        )
+
+    @staticmethod
+    def is_concurrent_update_error(error):
+        if not isinstance(error, BadRequest):
+            return False
+        return CONCURRENT_UPDATE_MESSAGE in str(error.message)
+
+    async def run_job(self, limiter, submit):
+        """
+        Run the job returned by `submit` within the run-wide `limiter`,
+        backing off and resubmitting it when BigQuery reports a quota error,
+        or when a MERGE conflicted with another updating the same partitions,
+        as uncoalesced writes, early flushes and shards can run concurrently.
+
+        Submitting uploads the job's data and inserts the job, so it runs on
+        a thread like the wait for its result, keeping the event loop free
+        for the requests of other exports.
+        """
+        for attempt in range(self.max_job_retries + 1):
+            async with limiter:
+                try:
+                    job = await asyncio.to_thread(submit)
+                    await asyncio.to_thread(job.result)
+                except (BadRequest, Forbidden, TooManyRequests) as e:
+                    if attempt == self.max_job_retries:
+                        raise
+                    if self.is_quota_error(e):
+                        metrics.incr("bigquery_throttled")
+                        limiter.throttle()
+                    elif self.is_concurrent_update_error(e):
+                        metrics.incr("bigquery_dml_conflicts")
+                    else:
+                        raise
+                    reason = e.message
+                else:
+                    limiter.succeed()
+                    return job
+
+            # Exponential backoff with full jitter
+            delay = random.uniform(
+                0, min(self.job_backoff_max, self.job_backoff_base * 2**attempt)
+            )
+            print(f"Retrying BigQuery job in {delay:.1f}s ({reason})")
+            await asyncio.sleep(delay)
+
+    async def create_staging_table(self, bq_client, table_name, schema):
+        staging_fqid = f"{self.dataset}.{table_name}__staging_{uuid4().hex}"
+
+        table = bigquery.Table(staging_fqid, schema=schema)
+        # Expire staging tables that outlive a crashed run
+        table.expires = datetime.now(timezone.utc) + STAGING_TABLE_EXPIRATION
+        await asyncio.to_thread(bq_client.create_table, table)
+
+        return staging_fqid
+
+    @staticmethod
+    def get_slices(table):
+        """
+        Distinct (date, app_name) pairs in an Arrow table
+        """
+        pairs = table.group_by(["date", "app_name"]).aggregate([])
+        return list(zip(pairs["date"].to_pylist(), pairs["app_name"].to_pylist()))
+
+    async def replace_slice(self, bq_client, table_fqid, staging_fqid, slices):
+        # Deleting the existing rows of each (date, app_name) and inserting the
+        # staged rows in one MERGE makes the replacement atomic and idempotent.
+        # Pairs are matched exactly since apps written together may cover
+        # different dates.
+        query = f"""
+            MERGE `{table_fqid}` T
+            USING `{staging_fqid}` S
+            ON FALSE
+            WHEN NOT MATCHED BY SOURCE
+                AND T.date IN UNNEST(@dates)
+                AND CONCAT(CAST(T.date AS STRING), '/', T.app_name) IN UNNEST(@slices)
+                THEN DELETE
+            WHEN NOT MATCHED BY TARGET THEN INSERT ROW
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter(
+                    "dates", "DATE", sorted({date for date, _ in slices})
+                ),
+                bigquery.ArrayQueryParameter(
+                    "slices",
+                    "STRING",
+                    [f"{date.isoformat()}/{app_name}" for date, app_name in slices],
+                ),
+            ]
+        )
+
+        with metrics.timer("bigquery_dml_job"):
+            job = await self.run_job(
+                get_controller().bigquery_dml,
+                lambda: bq_client.query(query, job_config=job_config),
+            )
+        metrics.incr("bigquery_dml_jobs")
+        metrics.incr("bigquery_bytes_billed", job.total_bytes_billed or 0)
 
-            job.result()
+    async def write_table(self, measure, dimension, table, overwrite):
+        """
+        Write an Arrow table with the columns of `get_schema`, replacing the
+        rows of every (date, app_name) it contains. Slices whose rows are
+        unchanged since they were last written are skipped.
+        """
+        bq_client = self.bq_client
+
+        schema = BigqueryClient.get_schema(measure, dimension)
+        table_name = BigqueryClient.get_table_name(measure, dimension)
+        table_fqid = f"{self.dataset}.{table_name}"
+
+        digest_store = get_digest_store()
+        if digest_store is not None:
+            # Hashing every row is CPU bound, so it is kept off the event loop
+            with metrics.timer("digest"):
+                if overwrite:
+                    digests = await asyncio.to_thread(get_slice_digests, table)
+                else:
+                    table, digests = await asyncio.to_thread(
+                        digest_store.select_changed, table_name, table
+                    )
+            if not digests:
+                return table_name
+
+        try:
+            if overwrite:
+                await self.load_table(bq_client, table_fqid, schema, table)
+
+            else:
+                staging_fqid = await self.create_staging_table(
+                    bq_client, table_name, schema
+                )
+                try:
+                    await self.load_table(bq_client, staging_fqid, schema, table)
+                    slices = await asyncio.to_thread(BigqueryClient.get_slices, table)
+                    await self.replace_slice(
+                        bq_client, table_fqid, staging_fqid, slices
+                    )
+                finally:
+                    await asyncio.to_thread(
+                        bq_client.delete_table, staging_fqid, not_found_ok=True
+                    )
+        except NotFound:
+            # The table was dropped since it was cached; recheck next write
+            self.invalidate(table_fqid)
+            raise
 
-        os.remove(temp_file.name)
+        if digest_store is not None:
+            # Truncating the table drops the slices it no longer contains
+            digest_store.record(table_name, digests, replace=overwrite)
         return table_name
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from uuid import uuid4
+
+from .metrics import metrics
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of App Store Connect responses.
+
+    Entries hold the raw response body after a one-line JSON header, so that
+    bodies can be written as they stream in and parsed incrementally when
+    read back.
+    Responses covering the last `mutable_days` days may still be revised by
+    Apple and expire after `recent_ttl`; older responses never expire. The
+    cache is bounded to `max_bytes`, evicting least recently used entries.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes: int,
+        mutable_days: int,
+        recent_ttl: timedelta,
+        bypass: bool = False,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.mutable_days = mutable_days
+        self.recent_ttl = recent_ttl
+        # Bypassing skips reads but still refreshes the stored responses
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        self._size = None
+
+    @staticmethod
+    def make_key(**params) -> str:
+        canonical = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get_ttl(self, end_date) -> timedelta | None:
+        if end_date is None:
+            return self.recent_ttl
+        if isinstance(end_date, str):
+            end_date = date.fromisoformat(end_date[:10])
+        elif isinstance(end_date, datetime):
+            end_date = end_date.date()
+
+        if end_date >= date.today() - timedelta(days=self.mutable_days):
+            return self.recent_ttl
+        return None
+
+    def get_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def open(self, key: str):
+        """
+        Binary file of the cached body, or None on a miss. The caller closes
+        the file.
+        """
+        if self.bypass:
+            return None
+
+        path = self.get_path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            metrics.incr("response_cache_misses")
+            return None
+
+        try:
+            header = json.loads(f.readline())
+        except json.JSONDecodeError:
+            header = None
+        expired = (
+            not isinstance(header, dict)
+            or (header.get("expires_at") or float("inf")) < time.time()
+        )
+        if expired:
+            f.close()
+            self.delete(path)
+            metrics.incr("response_cache_misses")
+            return None
+
+        # Access time drives LRU eviction
+        os.utime(path)
+        metrics.incr("response_cache_hits")
+        return f
+
+    def get(self, key: str):
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return json.load(f)
+
+    @contextmanager
+    def writer(self, key: str, ttl: timedelta | None):
+        """
+        Binary file to write a body to. The entry is only stored if the
+        block completes without raising.
+        """
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        header = {"expires_at": time.time() + ttl.total_seconds() if ttl else None}
+        # Coroutines on one thread may write the same key at once, so each
+        # write has its own temporary file
+        suffix = f".{os.getpid()}.{threading.get_ident()}.{uuid4().hex}.tmp"
+        temp_path = path.with_suffix(suffix)
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(json.dumps(header).encode() + b"\n")
+                yield f
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        size = temp_path.stat().st_size
+
+        with self._lock:
+            self.get_size()
+            previous_size = path.stat().st_size if path.exists() else 0
+            os.replace(temp_path, path)
+            self._size += size - previous_size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def set(self, key: str, data, ttl: timedelta | None):
+        with self.writer(key, ttl) as f:
+            f.write(json.dumps(data).encode())
+
+    def delete(self, path: Path):
+        with self._lock:
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                return
+            if self._size is not None:
+                self._size -= size
+
+    def get_size(self) -> int:
+        if self._size is None:
+            self._size = sum(p.stat().st_size for p in self.directory.glob("*/*.json"))
+        return self._size
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # Evict down to 90% so that every write does not trigger a scan
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if self._size <= target:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
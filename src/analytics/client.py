@@ -1,7 +1,20 @@
+import asyncio
+import functools
 import json
+import random
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import httpx
 
+from .cache import ResponseCache
+from .columns import GroupedColumns
+from .concurrency import get_controller
+from .metrics import metrics
+from .session import SessionStore
+from .table_metadata import metric_data
+
 
 class RequestError(Exception):
     def __init__(self, message, status):
@@ -9,44 +22,214 @@ class RequestError(Exception):
         self.status = status
 
 
+def on_client_loop(fn):
+    """
+    Run the coroutine on the event loop that owns the client's connection pool.
+
+    Prefect runs every task on its own event loop, so requests made from tasks
+    are handed over to the flow's loop instead of opening a pool per task.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self.loop is None:
+            self.loop = loop
+
+        if loop is self.loop:
+            return await fn(self, *args, **kwargs)
+
+        future = asyncio.run_coroutine_threadsafe(fn(self, *args, **kwargs), self.loop)
+        return await asyncio.wrap_future(future)
+
+    return wrapper
+
+
+class ResponseReader:
+    """
+    File-like view of a streamed response body for incremental parsers,
+    copying every chunk read to `sink` when given
+    """
+
+    def __init__(self, response: httpx.Response, sink=None):
+        self.chunks = response.aiter_bytes()
+        self.sink = sink
+        self.buffer = b""
+
+    async def read(self, size=-1) -> bytes:
+        if not self.buffer:
+            self.buffer = await anext(self.chunks, b"")
+            if self.buffer and self.sink is not None:
+                self.sink.write(self.buffer)
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
 class AnalyticsClient:
-    def __init__(self):
-        self.api_base_url = "https://appstoreconnect.apple.com/analytics/api/v1"
+    retry_statuses = {429, 500, 502, 503, 504}
+    # Cookies that make up an authenticated App Store Connect session
+    session_cookies = ("myacinfo", "itctx")
+    # Upper bound on measures requested together in one time-series call
+    max_measures_per_request = 10
+    # Groups of a dimension exported for each measure, ranked by that measure
+    group_limit = 10
+    # Groups requested by a call for several measures, so that each measure's
+    # own top groups can be picked from its response
+    max_groups_per_request = 200
+
+    def __init__(
+        self,
+        timeout: float = 30.0,
+        connect_timeout: float = 10.0,
+        max_connections: int = 20,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 60.0,
+        http2: bool = True,
+        cache: ResponseCache | None = None,
+        base_url: str = "https://appstoreconnect.apple.com",
+        auth_url: str = "https://idmsa.apple.com/appleauth/auth",
+    ):
+        self.api_base_url = f"{base_url}/analytics/api/v1"
+        self.session_url = f"{base_url}/olympus/v1/session"
+        self.auth_url = auth_url
         self.default_headers = {
             "Content-Type": "application/json",
             "Accept": "application/json, text/javascript, */*",
         }
         self.cookies = {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.loop = None
+        self.cache = cache
+        self.session_store = None
+        self.credentials = None
+        # One pooled, keep-alive client per AnalyticsClient so that every
+        # request in an export reuses the same connections and TLS sessions
+        self.http = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    def get_retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get("retry-after") if response else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0)
+            except ValueError:
+                pass
+            # Otherwise an HTTP date; malformed ones fall back to the backoff
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                retry_at = None
+            if retry_at is not None:
+                # Dates without a zone ("-0000") are in UTC
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=timezone.utc)
+                now = datetime.now(timezone.utc)
+                return max((retry_at - now).total_seconds(), 0)
+
+        # Exponential backoff with full jitter
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**attempt)
+        )
+
+    @on_client_loop
+    async def request(self, method, url, stream=False, **kwargs):
+        """
+        Send a request, retrying transport errors and retryable statuses.
+
+        With `stream`, a successful response is returned before its body is
+        read, and the caller must read or close it on the client's loop.
+        """
+        # Shared by every client in the run; backs off on 429s
+        limiter = get_controller().app_store
+
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                async with limiter:
+                    with metrics.timer("app_store_request"):
+                        response = await self.http.send(
+                            self.http.build_request(method, url, **kwargs),
+                            stream=stream,
+                        )
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    metrics.incr("app_store_errors")
+                    raise
+                reason = repr(e)
+            else:
+                if response.status_code == 429:
+                    metrics.incr("app_store_throttled")
+                    limiter.throttle()
+                elif response.is_success:
+                    limiter.succeed()
+                if (
+                    response.status_code not in self.retry_statuses
+                    or attempt == self.max_retries
+                ):
+                    if not response.is_success:
+                        metrics.incr("app_store_errors")
+                        # Error bodies are small and read for their messages
+                        await response.aread()
+                    return response
+                await response.aclose()
+                reason = response.status_code
+
+            metrics.incr("app_store_retries")
+            delay = self.get_retry_delay(attempt, response)
+            print(f"Retrying {method} {url} in {delay:.1f}s ({reason})")
+            await asyncio.sleep(delay)
 
     def set_cookies(self, response):
-        set_cookie_header = response.headers.get("set-cookie")
-        if set_cookie_header:
-            cookie_pairs = set_cookie_header.split(";")
-            for pair in cookie_pairs:
-                key, value = pair.split("=")
-                self.cookies[key] = value
+        # httpx parses every Set-Cookie header and drops attributes such as
+        # Path or Secure; only the session cookies are kept and persisted
+        for name in self.session_cookies:
+            value = response.cookies.get(name)
+            if value is not None:
+                self.cookies[name] = value
 
     @property
     def headers(self):
-        cookies = " ".join([f"{k}={v}" for k, v in self.cookies.items()])
+        cookies = "; ".join([f"{k}={v}" for k, v in self.cookies.items()])
         return {**self.default_headers, "Cookie": cookies}
 
     @staticmethod
     def check_response_for_error(response, start_message, end_message=None):
-        if not response.ok:
+        if not response.is_success:
             raise RequestError(
-                f"{start_message}: {response.status} {response.statusText} {end_message or ''}",  # noqa
-                response.status,
+                f"{start_message}: {response.status_code} {response.reason_phrase} {end_message or ''}",  # noqa
+                response.status_code,
             )
 
     async def login(self, username, password, test_code=None):
-        base_auth_url = "https://idmsa.apple.com/appleauth/auth"
-        session_url = "https://appstoreconnect.apple.com/olympus/v1/session"
+        base_auth_url = self.auth_url
         login_headers = {
             "X-Apple-Widget-Key": "e0b80c3bf78523bfe80974d320935bfa30add02e1bff88ec2166c6bd5a706c42",  # noqa
         }
 
-        login_response = await httpx.post(
+        login_response = await self.request(
+            "POST",
             f"{base_auth_url}/signin?isRememberMeEnabled=true",
             json={
                 "accountName": username,
@@ -56,19 +239,19 @@ class AnalyticsClient:
             headers={**self.headers, **login_headers},
         )
 
-        if not login_response.ok:
-            if login_response.status == 409:
+        if not login_response.is_success:
+            if login_response.status_code == 409:
                 print("Attempting to handle 2-step verification")
                 login_headers["X-Apple-ID-Session-Id"] = login_response.headers.get(
                     "X-Apple-ID-Session-Id"
                 )
                 login_headers["scnt"] = login_response.headers.get("scnt")
-                code_request_response = await httpx.get(
-                    base_auth_url, headers={**self.headers, **login_headers}
+                code_request_response = await self.request(
+                    "GET", base_auth_url, headers={**self.headers, **login_headers}
                 )
 
-                if not code_request_response.ok:
-                    if code_request_response.status == 423:
+                if not code_request_response.is_success:
+                    if code_request_response.status_code == 423:
                         print(
                             "Too many codes requested, try again later or use last code"
                         )
@@ -84,7 +267,8 @@ class AnalyticsClient:
                     if not code:
                         raise ValueError("No 2SV code given")
 
-                login_response = await httpx.post(
+                login_response = await self.request(
+                    "POST",
                     f"{base_auth_url}/verify/phone/securitycode",
                     json={
                         "mode": "sms",
@@ -93,12 +277,13 @@ class AnalyticsClient:
                     },
                     headers={**self.headers, **login_headers},
                 )
-            elif login_response.status == 412:
+            elif login_response.status_code == 412:
                 login_headers["X-Apple-ID-Session-Id"] = login_response.headers.get(
                     "X-Apple-ID-Session-Id"
                 )
                 login_headers["scnt"] = login_response.headers.get("scnt")
-                login_response = await httpx.post(
+                login_response = await self.request(
+                    "POST",
                     f"{base_auth_url}/repair/complete",
                     headers={**self.headers, **login_headers},
                 )
@@ -109,7 +294,7 @@ class AnalyticsClient:
             else:
                 message = (
                     "Invalid username and password"
-                    if login_response.status == 401
+                    if login_response.status_code == 401
                     else "Unrecognized error"
                 )
                 self.check_response_for_error(
@@ -120,13 +305,65 @@ class AnalyticsClient:
         if "myacinfo" not in self.cookies:
             raise ValueError("Could not find account info cookie")
 
-        session_response = await httpx.get(session_url, headers=self.headers)
+        session_response = await self.request(
+            "GET", self.session_url, headers=self.headers
+        )
         self.check_response_for_error(session_response, "Could not get session cookie")
 
         self.set_cookies(session_response)
         if "itctx" not in self.cookies:
             raise ValueError("Could not find session cookie")
 
+    async def validate_session(self):
+        response = await self.request("GET", self.session_url, headers=self.headers)
+        return response.is_success
+
+    async def authenticate(self, session_store: SessionStore, username, password):
+        """
+        Reuse the session persisted in `session_store`, logging in only when
+        no stored session exists or it is no longer valid
+        """
+        self.session_store = session_store
+        self.credentials = (username, password)
+
+        async with session_store.get_lock():
+            if session_store.cookies is None:
+                self.cookies = await session_store.read() or {}
+                if not self.cookies or not await self.validate_session():
+                    self.cookies = {}
+                    await self.login(username, password)
+                    await session_store.write(self.cookies)
+                session_store.cookies = dict(self.cookies)
+
+        self.cookies = dict(session_store.cookies)
+
+    async def reauthenticate(self, stale_cookies):
+        async with self.session_store.get_lock():
+            # Another client may already have replaced the expired session
+            if self.session_store.cookies == stale_cookies:
+                self.cookies = {}
+                await self.login(*self.credentials)
+                await self.session_store.write(self.cookies)
+                self.session_store.cookies = dict(self.cookies)
+
+        self.cookies = dict(self.session_store.cookies)
+
+    @on_client_loop
+    async def authenticated_request(self, method, url, headers=None, **kwargs):
+        cookies = dict(self.cookies)
+        response = await self.request(
+            method, url, headers={**self.headers, **(headers or {})}, **kwargs
+        )
+
+        if response.status_code == 401 and self.session_store:
+            print("Session expired, logging in again")
+            await self.reauthenticate(cookies)
+            response = await self.request(
+                method, url, headers={**self.headers, **(headers or {})}, **kwargs
+            )
+
+        return response
+
     def is_authenticated(self, name):
         if "myacinfo" not in self.cookies or "itctx" not in self.cookies:
             raise ValueError(
@@ -136,27 +373,39 @@ class AnalyticsClient:
     async def get_metadata(self):
         # self.is_authenticated("get_metadata")
 
-        settings_response = await httpx.get(
-            f"{self.api_base_url}/settings/all", headers=self.headers
+        cache_key = ResponseCache.make_key(request="settings")
+        if self.cache and (cached := self.cache.get(cache_key)) is not None:
+            return cached
+
+        settings_response = await self.authenticated_request(
+            "GET", f"{self.api_base_url}/settings/all"
         )
 
-        data = json.loads(await settings_response.text())
+        data = settings_response.json()
         self.check_response_for_error(
             settings_response, "Could not get API settings", data.get("errors")
         )
 
+        if self.cache:
+            self.cache.set(cache_key, data, self.cache.recent_ttl)
+
         return data
 
-    async def get_metric(self, app_id, metric, dimension, start_date, end_date):
+    async def get_metric(
+        self, app_id, metric, dimension, start_date, end_date, limit=None
+    ) -> GroupedColumns:
         # self.is_authenticated("get_metric")
 
+        measures = [metric] if not isinstance(metric, list) else metric
+        limit = limit or self.group_limit
         request_body = {
             "adamId": [app_id],
-            "measures": [metric] if not isinstance(metric, list) else metric,
+            "measures": measures,
             "group": {
                 "dimension": dimension,
-                "metric": metric,
-                "limit": 10,
+                # Groups are ranked by a single measure
+                "metric": measures[0],
+                "limit": limit,
                 "rank": "DESCENDING",
             }
             if dimension
@@ -166,17 +415,128 @@ class AnalyticsClient:
             "endTime": f"{end_date}T00:00:00Z",
         }
 
-        metrics_response = await httpx.post(
-            "https://appstoreconnect.apple.com/analytics/api/v1/data/time-series",
-            json=request_body,
-            headers={**self.headers, "X-Requested-By": "dev.apple.com"},
+        cache_key = ResponseCache.make_key(
+            app_id=app_id,
+            measures=measures,
+            dimension=dimension,
+            limit=limit if dimension else None,
+            frequency=request_body["frequency"],
+            start_date=start_date,
+            end_date=end_date,
         )
+        if self.cache and (cached := self.cache.open(cache_key)) is not None:
+            with cached:
+                return GroupedColumns.parse(cached, measures)
 
-        data = json.loads(await metrics_response.text())
-        self.check_response_for_error(
-            metrics_response,
-            "Could not get metrics",
-            f"\n{json.dumps(data.get('errors'), indent=2) or ''}",
+        return await self.stream_metric(
+            request_body, cache_key, self.cache and self.cache.get_ttl(end_date)
         )
 
-        return data
+    @on_client_loop
+    async def stream_metric(self, request_body, cache_key, ttl) -> GroupedColumns:
+        """
+        Parse a time-series response as its body arrives, writing the body
+        to the cache as it goes
+        """
+        for attempt in range(self.max_retries + 1):
+            metrics_response = await self.authenticated_request(
+                "POST",
+                f"{self.api_base_url}/data/time-series",
+                json=request_body,
+                headers={"X-Requested-By": "dev.apple.com"},
+                stream=True,
+            )
+
+            if not metrics_response.is_success:
+                try:
+                    errors = metrics_response.json().get("errors")
+                except ValueError:
+                    errors = None
+                self.check_response_for_error(
+                    metrics_response,
+                    "Could not get metrics",
+                    f"\n{json.dumps(errors, indent=2) or ''}",
+                )
+
+            cache_writer = (
+                self.cache.writer(cache_key, ttl) if self.cache else nullcontext()
+            )
+            try:
+                # Incomplete or invalid bodies raise before they are cached
+                with cache_writer as cache_file:
+                    return await GroupedColumns.parse_async(
+                        ResponseReader(metrics_response, cache_file),
+                        request_body["measures"],
+                    )
+            except httpx.TransportError as e:
+                # The body was cut off after the request itself succeeded
+                if attempt == self.max_retries:
+                    metrics.incr("app_store_errors")
+                    raise
+                reason = repr(e)
+            finally:
+                await metrics_response.aclose()
+
+            metrics.incr("app_store_retries")
+            delay = self.get_retry_delay(attempt)
+            print(f"Retrying time-series body in {delay:.1f}s ({reason})")
+            await asyncio.sleep(delay)
+
+    @classmethod
+    def get_measure_batches(cls, measures):
+        # Opt-in and non opt-in measures come from different data sets, so
+        # only measures sharing the opt-in flag are requested together
+        by_optin = {}
+        for measure in measures:
+            by_optin.setdefault(metric_data[measure]["optin"], []).append(measure)
+
+        size = cls.max_measures_per_request
+        return [
+            group[i : i + size]
+            for group in by_optin.values()
+            for i in range(0, len(group), size)
+        ]
+
+    async def get_metrics(self, app_id, measures, dimension, start_date, end_date):
+        async def get_batch(batch):
+            if not dimension or len(batch) == 1:
+                grouped = await self.get_metric(
+                    app_id, batch, dimension, start_date, end_date
+                )
+                return grouped.to_columns()
+
+            # The response ranks groups by the first measure only, so enough
+            # groups are requested to take every measure's own top groups
+            grouped = await self.get_metric(
+                app_id,
+                batch,
+                dimension,
+                start_date,
+                end_date,
+                self.max_groups_per_request,
+            )
+            # Converted as each response arrives so that the groups of a
+            # batch are not all held at once
+            columns_by_measure = grouped.to_columns(top=self.group_limit)
+            if len(grouped) < self.max_groups_per_request:
+                return columns_by_measure
+
+            # Only the first measure's top groups are certain to be in a
+            # truncated response; the others are requested on their own
+            metrics.incr("app_store_truncated_batches")
+            refetched = await asyncio.gather(
+                *[get_batch([measure]) for measure in batch[1:]]
+            )
+            for columns in refetched:
+                columns_by_measure.update(columns)
+            return columns_by_measure
+
+        responses = await asyncio.gather(
+            *[get_batch(batch) for batch in self.get_measure_batches(measures)]
+        )
+
+        columns_by_measure = {}
+        for response in responses:
+            columns_by_measure.update(response)
+
+        return columns_by_measure
@@ -0,0 +1,159 @@
+from array import array
+from datetime import date
+
+import ijson
+import pyarrow as pa
+
+from .bigquery import BigqueryClient
+from .table_metadata import metric_data
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+class MeasureColumns:
+    """
+    Typed, array-backed columns of one measure's rows, filled straight from
+    time-series responses without building a dict per row.
+
+    Dates are kept as days since the epoch, values as int64 or float64
+    following `metric_data`, and dimension values as indices into a list of
+    interned distinct values. `to_arrow` wraps the buffers without copying
+    them row by row.
+    """
+
+    def __init__(self, measure):
+        self.measure = measure
+        self.value_type = metric_data[measure]["type"]
+        self.dates = array("i")
+        self.values = array("q" if self.value_type == "INT64" else "d")
+        self.dimension_ids = array("i")
+        self.dimension_values = []
+        self._dimension_ids = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    @staticmethod
+    def to_day(date_string: str) -> int:
+        return date.fromisoformat(date_string[:10]).toordinal() - EPOCH
+
+    def intern(self, dimension_value) -> int:
+        dimension_id = self._dimension_ids.get(dimension_value)
+        if dimension_id is None:
+            dimension_id = len(self.dimension_values)
+            self._dimension_ids[dimension_value] = dimension_id
+            self.dimension_values.append(dimension_value)
+        return dimension_id
+
+    def append(self, day: int, value, dimension_id: int):
+        self.dates.append(day)
+        self.values.append(int(value) if self.value_type == "INT64" else value)
+        self.dimension_ids.append(dimension_id)
+
+    def extend(self, other: "MeasureColumns"):
+        self.dates.extend(other.dates)
+        self.values.extend(other.values)
+        # Dimension ids are only meaningful within their own columns
+        remap = [self.intern(value) for value in other.dimension_values]
+        self.dimension_ids.extend(remap[i] for i in other.dimension_ids)
+
+    @staticmethod
+    def wrap(buffer: array, arrow_type, length) -> pa.Array:
+        return pa.Array.from_buffers(arrow_type, length, [None, pa.py_buffer(buffer)])
+
+    def to_arrow(self, app_name, dimension) -> pa.Table:
+        length = len(self)
+        dimension_ids = self.wrap(self.dimension_ids, pa.int32(), length)
+
+        # Columns follow the field order of get_schema
+        schema = BigqueryClient.get_arrow_schema(self.measure, dimension)
+        columns = [
+            self.wrap(self.dates, pa.date32(), length),
+            pa.array([app_name] * length, pa.string()),
+            self.wrap(self.values, schema.field(2).type, length),
+            pa.array(self.dimension_values, pa.string()).take(dimension_ids),
+        ]
+        return pa.Table.from_arrays(columns[: len(schema)], schema=schema)
+
+
+class GroupedColumns:
+    """
+    MeasureColumns of each group of a time-series response, kept apart until
+    the groups exported for each measure are known.
+
+    A response ranks its groups by a single measure. When several measures
+    are requested together, each measure's own top groups are picked from
+    the response by their total for that measure.
+    """
+
+    def __init__(self, measures):
+        self.measures = list(measures)
+        # (dimension value, {measure: MeasureColumns}) per group
+        self.groups = []
+
+    # Responses are parsed incrementally, one group's result at a time, so
+    # that memory follows the largest group rather than the whole document
+    @classmethod
+    def parse(cls, f, measures) -> "GroupedColumns":
+        """
+        Parse a time-series response body from a binary file
+        """
+        grouped = cls(measures)
+        for result in ijson.items(f, "results.item", use_float=True):
+            grouped.add_result(result)
+        return grouped
+
+    @classmethod
+    async def parse_async(cls, f, measures) -> "GroupedColumns":
+        """
+        Parse a time-series response body from an object with an async
+        `read`, as its bytes arrive
+        """
+        grouped = cls(measures)
+        async for result in ijson.items_async(f, "results.item", use_float=True):
+            grouped.add_result(result)
+        return grouped
+
+    def __len__(self):
+        return len(self.groups)
+
+    def add_result(self, result: dict):
+        group = result.get("group") or {}
+        dimension_value = group.get("title", group.get("key"))
+        columns_by_measure = {}
+        for measure in self.measures:
+            columns = columns_by_measure[measure] = MeasureColumns(measure)
+            columns.intern(dimension_value)
+
+        # Every group repeats the same dates
+        days = {}
+        for entry in result.get("data") or []:
+            date_string = entry["date"]
+            day = days.get(date_string)
+            if day is None:
+                day = days[date_string] = MeasureColumns.to_day(date_string)
+
+            for measure, columns in columns_by_measure.items():
+                value = entry.get(measure)
+                if value is not None:
+                    columns.append(day, value, 0)
+
+        self.groups.append((dimension_value, columns_by_measure))
+
+    def to_columns(self, top: int | None = None) -> dict:
+        """
+        MeasureColumns per measure, of every group or of the `top` groups
+        with the largest totals for that measure
+        """
+        columns_by_measure = {}
+        for measure in self.measures:
+            groups = [columns[measure] for _, columns in self.groups]
+            if top is not None:
+                # Sorting is stable, so ties keep the response's ranking
+                groups = sorted(groups, key=lambda g: sum(g.values), reverse=True)
+                groups = groups[:top]
+
+            merged = columns_by_measure[measure] = MeasureColumns(measure)
+            for columns in groups:
+                merged.extend(columns)
+        return columns_by_measure
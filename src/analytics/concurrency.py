@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+
+DEFAULT_RUN_LIMIT = 50
+
+# Shared by every app export in this process so that concurrent subflows
+# stay within the App Store Connect and BigQuery limits as a whole.
+_run_limit = None
+_controller = None
+
+
+def set_run_limit(limit: int):
+    global _run_limit
+    _run_limit = asyncio.Semaphore(limit)
+
+
+def get_run_limit() -> asyncio.Semaphore:
+    """
+    Run-wide limit on concurrent export tasks, as opposed to the requests and
+    jobs they make, which the ConcurrencyController budgets. Each export task
+    holds its fetched responses and Arrow tables until they are written and
+    runs as its own Prefect task, so this bounds the memory and orchestration
+    overhead of a run however fast its calls are allowed to go.
+    """
+    if _run_limit is None:
+        set_run_limit(DEFAULT_RUN_LIMIT)
+    return _run_limit
+
+
+@asynccontextmanager
+async def bounded(*semaphores: asyncio.Semaphore):
+    # Acquire in a fixed order (per-app first, then run-wide) to avoid one app
+    # holding run-wide slots while it waits on its own limit.
+    async with AsyncExitStack() as stack:
+        for semaphore in semaphores:
+            await stack.enter_async_context(semaphore)
+        yield
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that tunes itself with AIMD.
+
+    Every success grows the limit by `increase / limit`, so about `increase`
+    per full window of calls, up to `maximum`. A throttled call multiplies it
+    by `decrease`, at most once per `cooldown` seconds so that a burst of
+    throttling from one window only backs off once.
+
+    Prefect runs each task on its own thread and event loop, so the limiter
+    keeps its state under a thread lock and wakes waiters on their own loops.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        maximum: int,
+        minimum: int = 1,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        cooldown: float = 2.0,
+    ):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.waiters = deque()
+        self.last_decrease = float("-inf")
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self.waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            waiter = loop.create_future()
+            self.waiters.append((loop, waiter))
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if (loop, waiter) in self.waiters:
+                    self.waiters.remove((loop, waiter))
+                    raise
+            # The slot was granted as the wait was cancelled; hand it back
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.wake()
+
+    def wake(self):
+        # Called with the lock held
+        while self.waiters and self.in_flight < int(self.limit):
+            loop, waiter = self.waiters.popleft()
+            self.in_flight += 1
+            try:
+                loop.call_soon_threadsafe(self.grant, waiter)
+            except RuntimeError:
+                # The waiter's loop has closed
+                self.in_flight -= 1
+
+    def grant(self, waiter):
+        # Runs on the waiter's loop
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    def succeed(self):
+        with self._lock:
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self.wake()
+
+    def throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            limit = int(self.limit)
+        print(f"Throttled, reducing {self.name} concurrency to {limit}")
+
+
+class ConcurrencyController:
+    """
+    Run-wide concurrency budgets for App Store Connect requests, BigQuery
+    load jobs and BigQuery DML, each tuned independently.
+    """
+
+    def __init__(
+        self,
+        app_store: AdaptiveLimiter,
+        bigquery_load: AdaptiveLimiter,
+        bigquery_dml: AdaptiveLimiter,
+    ):
+        self.app_store = app_store
+        self.bigquery_load = bigquery_load
+        self.bigquery_dml = bigquery_dml
+
+    @classmethod
+    def create(
+        cls,
+        app_store: tuple = (16, 64),
+        bigquery_load: tuple = (25, 90),
+        bigquery_dml: tuple = (10, 20),
+    ):
+        """
+        Create a controller from (initial, maximum) limits per budget
+        """
+        return cls(
+            app_store=AdaptiveLimiter("app_store", *app_store),
+            bigquery_load=AdaptiveLimiter("bigquery_load", *bigquery_load),
+            bigquery_dml=AdaptiveLimiter("bigquery_dml", *bigquery_dml),
+        )
+
+
+def set_controller(controller: ConcurrencyController):
+    global _controller
+    _controller = controller
+
+
+def get_controller() -> ConcurrencyController:
+    if _controller is None:
+        set_controller(ConcurrencyController.create())
+    return _controller
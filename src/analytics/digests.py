@@ -0,0 +1,204 @@
+import hashlib
+import threading
+from collections import defaultdict
+from datetime import date, timedelta
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .metrics import metrics
+from .stores import JsonStore
+from .watermarks import to_date
+
+_digest_store = None
+
+KEY_COLUMNS = ["date", "app_name"]
+# Separate the values of a row and the rows of a slice before hashing
+VALUE_SEPARATOR = "\x1f"
+ROW_SEPARATOR = "\x1e"
+NULL = "\x00"
+
+
+def get_slice_keys(table: pa.Table) -> pa.Array:
+    return pc.binary_join_element_wise(
+        pc.cast(table["date"], pa.string()), table["app_name"], "/"
+    )
+
+
+def get_slice_digests(table: pa.Table) -> dict:
+    """
+    Digest of the rows of each (date, app_name) slice of an Arrow table,
+    keyed by "date/app_name", that does not depend on the order of the rows
+    """
+    columns = [
+        pc.fill_null(pc.cast(table[name], pa.string()), NULL)
+        for name in table.column_names
+        if name not in KEY_COLUMNS
+    ]
+    rows = pa.table(
+        {
+            "slice": get_slice_keys(table),
+            "row": pc.binary_join_element_wise(*columns, VALUE_SEPARATOR),
+        }
+    ).sort_by([("slice", "ascending"), ("row", "ascending")])
+
+    # Grouping without threads keeps the sorted order of each slice's rows
+    grouped = rows.group_by("slice", use_threads=False).aggregate([("row", "list")])
+    joined = pc.binary_join(grouped["row_list"], ROW_SEPARATOR)
+    return {
+        key: hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+        for key, value in zip(grouped["slice"].to_pylist(), joined.to_pylist())
+    }
+
+
+class DigestStore:
+    """
+    Digests of the rows last written to each (table, date, app_name) slice.
+
+    Writes only need to replace the slices whose digest changed; the others
+    already hold the same rows. The dates of the slices written are tracked
+    by table as pending until they have been transformed, so that only their
+    partitions are rebuilt, and those of a failed transformation are rebuilt
+    by the next run even though its writes are skipped.
+
+    Digests are recorded in memory as writes complete and persisted to
+    `store` with `save`, keeping those of the `retention_days` days up to the
+    latest date recorded. Older dates are not restated, so their digests are
+    not needed.
+    Like watermarks, shards of a sharded run return the digests they wrote
+    instead of persisting them.
+    """
+
+    def __init__(self, store: JsonStore, retention_days: int):
+        self.store = store
+        self.retention_days = retention_days
+        self.digests = None
+        # Dates written but not transformed yet, by table
+        self.pending = None
+        # Writes are only skipped when set; a full refresh rewrites every slice
+        self.skip_unchanged = True
+        self.persist = True
+        # Digests of the slices written since `start_run`, by table
+        self.written = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    async def load(self):
+        if self.digests is None:
+            document = await self.store.read() or {}
+            with self._lock:
+                if self.digests is None:
+                    self.digests = document.get("digests", {})
+                    self.pending = {
+                        table_name: set(dates)
+                        for table_name, dates in document.get("pending", {}).items()
+                    }
+
+    async def save(self):
+        if not self.persist:
+            return
+        with self._lock:
+            digests = self.digests or {}
+            # Keys start with the date in ISO format, so they sort by date
+            latest = max(
+                (max(slices) for slices in digests.values() if slices), default=None
+            )
+            if latest is not None:
+                latest_date = date.fromisoformat(latest.split("/", 1)[0])
+                oldest = (latest_date - timedelta(days=self.retention_days)).isoformat()
+                digests = {
+                    table_name: {
+                        key: digest for key, digest in slices.items() if key >= oldest
+                    }
+                    for table_name, slices in digests.items()
+                }
+            pending = {
+                table_name: sorted(dates)
+                for table_name, dates in (self.pending or {}).items()
+                if dates
+            }
+        await self.store.write({"digests": digests, "pending": pending})
+
+    def start_run(self, skip_unchanged: bool, persist: bool = True):
+        with self._lock:
+            self.skip_unchanged = skip_unchanged
+            self.persist = persist
+            self.written = defaultdict(dict)
+
+    def select_changed(self, table_name, table: pa.Table):
+        """
+        Rows of the slices whose digest changed, and their digests
+        """
+        digests = get_slice_digests(table)
+        with self._lock:
+            known = (self.digests or {}).get(table_name, {})
+            changed = {
+                key: digest
+                for key, digest in digests.items()
+                if not self.skip_unchanged or known.get(key) != digest
+            }
+
+        metrics.incr("slices_unchanged", len(digests) - len(changed))
+        metrics.incr("slices_written", len(changed))
+        if len(changed) < len(digests):
+            mask = pc.is_in(
+                get_slice_keys(table), value_set=pa.array(list(changed), pa.string())
+            )
+            table = table.filter(mask)
+        return table, changed
+
+    def record(self, table_name, digests: dict, replace: bool = False):
+        with self._lock:
+            if self.digests is None:
+                self.digests = {}
+            if self.pending is None:
+                self.pending = {}
+            if replace:
+                self.digests[table_name] = {}
+            self.digests.setdefault(table_name, {}).update(digests)
+            self.written[table_name].update(digests)
+            self.pending.setdefault(table_name, set()).update(
+                key.split("/", 1)[0] for key in digests
+            )
+
+    def get_pending(self, start_date=None, end_date=None) -> dict:
+        """
+        Dates written but not transformed yet, by table, between `start_date`
+        and `end_date` when given. These are the dates written during the run
+        and those left by earlier runs whose transformation failed.
+        """
+        start = to_date(start_date).isoformat() if start_date else ""
+        end = to_date(end_date).isoformat() if end_date else "9999-12-31"
+        with self._lock:
+            pending = {
+                table_name: {
+                    date.fromisoformat(day) for day in dates if start <= day <= end
+                }
+                for table_name, dates in (self.pending or {}).items()
+            }
+        return {table_name: dates for table_name, dates in pending.items() if dates}
+
+    def clear_pending(self, transformed: dict):
+        """
+        Forget the pending dates of `transformed`, by table, once their
+        partitions have been rebuilt
+        """
+        with self._lock:
+            for table_name, dates in transformed.items():
+                (self.pending or {}).get(table_name, set()).difference_update(
+                    day.isoformat() for day in dates
+                )
+
+    def get_written(self) -> dict:
+        with self._lock:
+            return {
+                table_name: dict(slices) for table_name, slices in self.written.items()
+            }
+
+
+def set_digest_store(store: DigestStore | None):
+    global _digest_store
+    _digest_store = store
+
+
+def get_digest_store() -> DigestStore | None:
+    return _digest_store
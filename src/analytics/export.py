@@ -1,12 +1,9 @@
 import asyncio
-import random
-from datetime import datetime
-
-from faker import Faker
-from faker.providers import company
+from datetime import datetime, timedelta
 
 from analytics.bigquery import BigqueryClient
 from analytics.client import AnalyticsClient
+from analytics.table_metadata import metric_data
 
 
 class AnalyticsExport:
@@ -17,41 +14,59 @@ class AnalyticsExport:
         self.app_id = app_id
         self.app_name = app_name
 
-        fake = Faker()
-        fake.add_provider(company)
-        self.fake = fake
-
-    def _generate_fake_data(
-        self, date: datetime, metric: dict, seed: int
-    ) -> int | float:
-        Faker.seed(seed)
-        if metric["type"] == "INT64":
-            return {
-                "date": date.strftime("%Y-%m-%d"),
-                "metric": random.randint(0, 10000),
-                "dimension": self.fake.company(),
-            }
-        elif metric["type"] == "FLOAT64":
-            return {
-                "date": date.strftime("%Y-%m-%d"),
-                "metric": round(random.uniform(0, 1), 2),
-                "dimension": self.fake.company(),
-            }
-
     @staticmethod
-    async def write_data(
-        bq_client: BigqueryClient, app_name, measure, dimension, data_by_date, overwrite
+    def get_date_windows(start_date: datetime, end_date: datetime, window_days: int):
+        windows = []
+        window_start = start_date
+        while window_start <= end_date:
+            window_end = min(window_start + timedelta(days=window_days - 1), end_date)
+            windows.append((window_start, window_end))
+            window_start = window_end + timedelta(days=1)
+        return windows
+
+    async def fetch_data(
+        self, dimension, start_date: datetime, end_date: datetime, measures=None
     ):
-        await bq_client.create_table_if_not_exists(measure, dimension)
+        return await self.client.get_metrics(
+            self.app_id,
+            list(measures or metric_data),
+            dimension,
+            start_date.strftime("%Y-%m-%d"),
+            end_date.strftime("%Y-%m-%d"),
+        )
+
+    async def fetch_date_range(
+        self,
+        dimension,
+        start_date: datetime,
+        end_date: datetime,
+        window_days: int,
+        measures=None,
+    ):
+        windows = self.get_date_windows(start_date, end_date, window_days)
+        responses = await asyncio.gather(
+            *[
+                self.fetch_data(dimension, window_start, window_end, measures)
+                for window_start, window_end in windows
+            ]
+        )
 
-        write_promises = []
+        columns_by_measure = {}
+        for response in responses:
+            for measure, columns in response.items():
+                if measure in columns_by_measure:
+                    columns_by_measure[measure].extend(columns)
+                else:
+                    columns_by_measure[measure] = columns
 
-        for date, data in data_by_date.items():
-            if not data:
-                continue
+        return columns_by_measure
 
-        write_promises.append(
-            bq_client.write_data(app_name, measure, dimension, date, data, overwrite)
-        )
+    @staticmethod
+    async def write_table(
+        bq_client: BigqueryClient, measure, dimension, table, overwrite
+    ):
+        await bq_client.create_table_if_not_exists(measure, dimension)
 
-        await asyncio.gather(*write_promises)
+        if table.num_rows:
+            await bq_client.write_table(measure, dimension, table, overwrite)
+        return table.num_rows
@@ -0,0 +1,150 @@
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+# App whose export is running in the current context; set by app_export and
+# inherited by its tasks so that metrics can be attributed per app
+current_app = ContextVar("current_app", default=None)
+
+RUN = "all"
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class PerformanceMetrics:
+    """
+    Thread-safe timings and counters for the export's hot paths.
+
+    Every observation is recorded for its app and for the run as a whole.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(Timing)
+        self.counters = Counter()
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def get_apps(self, app):
+        app = app or current_app.get()
+        return (RUN, app) if app and app != RUN else (RUN,)
+
+    def incr(self, name, value=1, app=None):
+        with self.lock:
+            for label in self.get_apps(app):
+                self.counters[(label, name)] += value
+
+    def observe(self, name, seconds, app=None):
+        with self.lock:
+            for label in self.get_apps(app):
+                self.timings[(label, name)].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, app=None):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, app)
+
+    def dump(self) -> dict:
+        """
+        Timings and counters as JSON, to be merged into another process's
+        metrics
+        """
+        with self.lock:
+            return {
+                "timings": [
+                    [app, name, timing.count, timing.total, timing.max]
+                    for (app, name), timing in self.timings.items()
+                ],
+                "counters": [
+                    [app, name, value] for (app, name), value in self.counters.items()
+                ],
+            }
+
+    def merge(self, dumped: dict):
+        with self.lock:
+            for app, name, count, total, max_seconds in dumped["timings"]:
+                timing = self.timings[(app, name)]
+                timing.count += count
+                timing.total += total
+                timing.max = max(timing.max, max_seconds)
+            for app, name, value in dumped["counters"]:
+                self.counters[(app, name)] += value
+
+    def get_rows(self):
+        with self.lock:
+            rows = [
+                {
+                    "app": app,
+                    "metric": f"{name}_seconds",
+                    "count": timing.count,
+                    "total": round(timing.total, 3),
+                    "mean": round(timing.total / timing.count, 3),
+                    "max": round(timing.max, 3),
+                }
+                for (app, name), timing in self.timings.items()
+            ] + [
+                {
+                    "app": app,
+                    "metric": name,
+                    "count": None,
+                    "total": value,
+                    "mean": None,
+                    "max": None,
+                }
+                for (app, name), value in self.counters.items()
+            ]
+
+        # Run totals first, then each app
+        return sorted(
+            rows, key=lambda row: (row["app"] != RUN, row["app"], row["metric"])
+        )
+
+    def to_markdown(self):
+        lines = [
+            "| app | metric | count | total | mean | max |",
+            "| --- | --- | --- | --- | --- | --- |",
+        ]
+        for row in self.get_rows():
+            values = ["" if value is None else str(value) for value in row.values()]
+            lines.append(f"| {' | '.join(values)} |")
+        return "\n".join(lines)
+
+    def to_openmetrics(self, prefix="app_store_analytics"):
+        families = defaultdict(list)
+        with self.lock:
+            for (app, name), timing in sorted(self.timings.items()):
+                family = (f"{prefix}_{name}_seconds", "summary")
+                families[family].append(f'_count{{app="{app}"}} {timing.count}')
+                families[family].append(f'_sum{{app="{app}"}} {timing.total}')
+            for (app, name), value in sorted(self.counters.items()):
+                family = (f"{prefix}_{name}", "counter")
+                families[family].append(f'_total{{app="{app}"}} {value}')
+
+        lines = []
+        for (family, metric_type), samples in families.items():
+            lines.append(f"# TYPE {family} {metric_type}")
+            lines.extend(f"{family}{sample}" for sample in samples)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by everything in the process so the whole run is aggregated together
+metrics = PerformanceMetrics()
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+from weakref import WeakKeyDictionary
+
+from .stores import JsonStore
+
+
+class SessionStore:
+    """
+    Persists the App Store Connect session cookies between runs in `store`.
+
+    A single store is shared by every AnalyticsClient in the process; once one
+    client has validated or established the session the others reuse it.
+    """
+
+    def __init__(self, store: JsonStore):
+        self.store = store
+        # Cookies known to be valid for this process
+        self.cookies = None
+        # Prefect runs tasks on their own threads and event loops, and asyncio
+        # locks only work on one loop, so each loop gets its own
+        self._locks = WeakKeyDictionary()
+        self._locks_lock = threading.Lock()
+
+    def get_lock(self) -> asyncio.Lock:
+        """
+        Lock serializing the logins of the clients on the running loop.
+        Clients on different loops may still both log in; a session replaced
+        by the other login is renewed on its next 401.
+        """
+        loop = asyncio.get_running_loop()
+        with self._locks_lock:
+            if loop not in self._locks:
+                self._locks[loop] = asyncio.Lock()
+            return self._locks[loop]
+
+    async def read(self) -> dict | None:
+        return await self.store.read()
+
+    async def write(self, cookies: dict):
+        await self.store.write(cookies)
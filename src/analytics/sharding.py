@@ -0,0 +1,232 @@
+import asyncio
+import heapq
+import multiprocessing
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+from prefect import flow
+
+from .digests import DigestStore
+from .export import AnalyticsExport
+from .metrics import metrics
+from .watermarks import WatermarkStore
+
+SHARD_BACKENDS = ("deployment", "process")
+
+
+def make_unit(app_id, app_name, start_date, end_date, export_dimensions=None) -> dict:
+    """
+    A unit of export work: some or, when `export_dimensions` is None, all
+    dimensions of an app between two dates. Units are passed to other
+    processes and deployment runs, so they only hold JSON values.
+    """
+    return {
+        "app_id": app_id,
+        "app_name": app_name,
+        "start_date": start_date.strftime("%Y-%m-%d"),
+        "end_date": end_date.strftime("%Y-%m-%d"),
+        "dimensions": export_dimensions,
+    }
+
+
+def get_unit_dates(unit: dict) -> tuple:
+    return (
+        datetime.fromisoformat(unit["start_date"]),
+        datetime.fromisoformat(unit["end_date"]),
+    )
+
+
+def plan_shards(
+    apps,
+    start_date,
+    end_date,
+    shards: int,
+    window_days: int,
+    plan_export,
+    watermark_store: WatermarkStore,
+    default_rows_per_day: float,
+) -> list:
+    """
+    Split the (app, dimension, date window) grid into at most `shards` lists
+    of export units with balanced expected rows. `plan_export(app_id,
+    start_date, end_date)` returns the date ranges still to export for each
+    (metric, dimension) of an app.
+
+    Each app and dimension is weighed by the days still to export times the
+    rows per day its latest exports wrote. Units are assigned heaviest first
+    to the lightest shard, and a shard's dimensions of the same app and
+    window are combined into one unit.
+    """
+    weighted = []
+    for app_id, app_name in apps:
+        windows = AnalyticsExport.get_date_windows(start_date, end_date, window_days)
+        for window_start, window_end in windows:
+            rows = Counter()
+            plans = plan_export(app_id, window_start, window_end)
+            for (metric, dimension), ranges in plans.items():
+                days = sum((end - start).days + 1 for start, end in ranges)
+                rows[dimension] += days * get_rows_per_day(
+                    watermark_store,
+                    watermark_store.make_key(app_id, metric, dimension),
+                    default_rows_per_day,
+                )
+            for dimension, dimension_rows in rows.items():
+                weighted.append(
+                    (
+                        dimension_rows,
+                        app_id,
+                        app_name,
+                        window_start,
+                        window_end,
+                        dimension,
+                    )
+                )
+
+    loads = [(0, shard) for shard in range(shards)]
+    assigned = [defaultdict(list) for _ in range(shards)]
+    for rows, app_id, app_name, window_start, window_end, dimension in sorted(
+        weighted, key=lambda unit: -unit[0]
+    ):
+        load, shard = heapq.heappop(loads)
+        assigned[shard][(app_id, app_name, window_start, window_end)].append(dimension)
+        heapq.heappush(loads, (load + rows, shard))
+
+    return [
+        [
+            make_unit(app_id, app_name, window_start, window_end, export_dimensions)
+            for (
+                app_id,
+                app_name,
+                window_start,
+                window_end,
+            ), export_dimensions in units.items()
+        ]
+        for units in assigned
+        if units
+    ]
+
+
+def get_rows_per_day(watermark_store: WatermarkStore, key, default: float) -> float:
+    watermark = watermark_store.get(key)
+    if watermark is None or "rows_per_day" not in watermark:
+        return default
+    # Every planned export costs at least its requests, even with no rows
+    return max(watermark["rows_per_day"], 1)
+
+
+async def export_shards(
+    shard_units: list,
+    backend,
+    deployment,
+    options: dict,
+    watermark_store: WatermarkStore,
+    digest_store: DigestStore,
+) -> dict:
+    """
+    Export the planned shards, each in its own process or run of the
+    `deployment`, merge the watermarks, digests and metrics they return and
+    save the stores. Returns the failures of every shard.
+    """
+    if not shard_units:
+        print("Every app is already exported, nothing to shard")
+        return {}
+
+    print(f"Exporting {len(shard_units)} shard(s) with the {backend} backend")
+    if backend == "process":
+        results = await run_shard_processes(shard_units, options)
+    else:
+        results = await asyncio.gather(
+            *[
+                run_shard_deployment(deployment, shard, units, options)
+                for shard, units in enumerate(shard_units)
+            ],
+            return_exceptions=True,
+        )
+
+    failures = {}
+    try:
+        for shard, result in enumerate(results):
+            if isinstance(result, BaseException):
+                failures[f"shard-{shard}"] = repr(result)
+            else:
+                failures.update(merge_shard(result, watermark_store, digest_store))
+    finally:
+        await watermark_store.save()
+        await digest_store.save()
+    return failures
+
+
+def merge_shard(
+    result: dict, watermark_store: WatermarkStore, digest_store: DigestStore
+) -> dict:
+    # Ranges are replayed in date order, so the latest dates' rows are kept
+    for key, start, end, rows in sorted(result["watermarks"], key=lambda r: r[1]):
+        watermark_store.record(
+            key, date.fromisoformat(start), date.fromisoformat(end), rows
+        )
+    for table_name, digests in result["digests"].items():
+        digest_store.record(table_name, digests)
+    metrics.merge(result["metrics"])
+    return result["failures"]
+
+
+def create_shard_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned rather than forked, since this process runs Prefect's threads
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def run_shard_processes(shard_units: list, options: dict) -> list:
+    loop = asyncio.get_running_loop()
+    with create_shard_pool(len(shard_units)) as pool:
+        return await asyncio.gather(
+            *[
+                loop.run_in_executor(pool, run_shard_process, shard, units, options)
+                for shard, units in enumerate(shard_units)
+            ],
+            return_exceptions=True,
+        )
+
+
+def run_shard_process(shard: int, units: list, options: dict) -> dict:
+    return asyncio.run(export_shard(shard, units, options))
+
+
+async def run_shard_deployment(deployment, shard: int, units: list, options: dict):
+    from prefect.deployments import run_deployment
+
+    flow_run = await run_deployment(
+        deployment,
+        parameters={"shard": shard, "units": units, "options": options},
+        timeout=None,
+    )
+    return await flow_run.state.result(fetch=True)
+
+
+# Deployments set the result storage that runs of the flow hand their results
+# back through, with `export_shard.with_options(result_storage=...)`
+@flow(flow_run_name="export-shard-{shard}", persist_result=True)
+async def export_shard(shard: int, units: list, options: dict) -> dict:
+    """
+    Export one shard of a sharded run. Watermarks and digests are returned
+    with the shard's metrics and failures instead of being saved, for the
+    parent run to merge.
+    """
+    # The flow's entrypoint module imports this one, so it is only imported
+    # once a shard runs, in its own process or deployment run
+    import app_store_analytics as pipeline
+
+    await pipeline.start_run(options, persist=False)
+
+    failures = {}
+    try:
+        await pipeline.export_apps(units, options)
+    except pipeline.ExportError as e:
+        failures = e.failures
+
+    return {
+        "failures": failures,
+        "watermarks": pipeline.watermark_store.recorded,
+        "digests": pipeline.digest_store.get_written(),
+        "metrics": metrics.dump(),
+    }
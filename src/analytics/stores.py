@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+STORE_KINDS = ("block", "file")
+
+
+class JsonStore(ABC):
+    """
+    Where a JSON document of state kept between runs, such as the session
+    cookies, watermarks or digests, is persisted
+    """
+
+    @abstractmethod
+    async def read(self) -> dict | None:
+        """
+        The stored document, or None when nothing has been stored yet
+        """
+
+    @abstractmethod
+    async def write(self, document: dict):
+        pass
+
+
+class FileJsonStore(JsonStore):
+    def __init__(self, path, private: bool = False):
+        self.path = Path(path)
+        # Documents holding credentials are only readable by their owner
+        self.private = private
+
+    async def read(self) -> dict | None:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    async def write(self, document: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Replaced atomically so that readers never see a partial document
+        temp_path = self.path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        mode = 0o600 if self.private else 0o666
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "w") as f:
+            json.dump(document, f, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+class PrefectBlockJsonStore(JsonStore):
+    def __init__(self, block_name: str, secret: bool = False):
+        self.block_name = block_name
+        # Documents holding credentials are stored in a Secret block
+        self.secret = secret
+
+    async def read(self) -> dict | None:
+        from prefect.blocks.system import JSON, Secret
+
+        try:
+            block = await (Secret if self.secret else JSON).load(self.block_name)
+        except ValueError:
+            return None
+        return json.loads(block.get()) if self.secret else block.value
+
+    async def write(self, document: dict):
+        from prefect.blocks.system import JSON, Secret
+
+        block = (
+            Secret(value=json.dumps(document)) if self.secret else JSON(value=document)
+        )
+        await block.save(self.block_name, overwrite=True)
+
+
+def create_store(kind: str, path, block_name: str, secret: bool = False) -> JsonStore:
+    """
+    Store of the configured `kind`: a Prefect block or a local file
+    """
+    if kind not in STORE_KINDS:
+        raise ValueError(f"Unknown store {kind}, expected {STORE_KINDS}")
+    if kind == "block":
+        return PrefectBlockJsonStore(block_name, secret=secret)
+    return FileJsonStore(path, private=secret)
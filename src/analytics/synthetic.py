@@ -0,0 +1,102 @@
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+
+from .bigquery import BigqueryClient
+from .export import AnalyticsExport
+from .table_metadata import metric_data
+
+
+class SyntheticDataGenerator:
+    """
+    Vectorized generator of fake export data for load testing.
+
+    Batches are Arrow tables with the columns of `BigqueryClient.get_schema`,
+    so they can be passed straight to `BigqueryClient.write_table`. Output is
+    reproducible from `seed` regardless of the order batches are generated in.
+    """
+
+    def __init__(self, seed: int = 0, pool_size: int = 1000):
+        self.seed = seed
+
+        # Faker is only used once, to build the pool that values are drawn from
+        from faker import Faker
+        from faker.providers import company
+
+        fake = Faker()
+        fake.add_provider(company)
+        fake.seed_instance(seed)
+        self.dimension_pool = pa.array(
+            [fake.company() for _ in range(pool_size)], type=pa.string()
+        )
+
+    def get_rng(self, *keys):
+        entropy = [self.seed] + [zlib.crc32(str(key).encode()) for key in keys]
+        return np.random.default_rng(entropy)
+
+    def generate(
+        self,
+        measure,
+        dimension,
+        app_names: list,
+        start_date: datetime,
+        end_date: datetime,
+        rows_per_day: int,
+    ) -> pa.Table:
+        rng = self.get_rng(measure, dimension, start_date.date(), end_date.date())
+
+        days = (end_date - start_date).days + 1
+        groups = days * len(app_names)
+        size = groups * rows_per_day
+
+        date_column = np.repeat(
+            np.datetime64(start_date.date(), "D") + np.arange(days),
+            len(app_names) * rows_per_day,
+        )
+        app_indices = np.tile(np.repeat(np.arange(len(app_names)), rows_per_day), days)
+
+        if metric_data[measure]["type"] == "INT64":
+            values = rng.integers(0, 10000, size, dtype=np.int64)
+        else:
+            values = np.round(rng.uniform(0, 1, size), 2)
+
+        # Consecutive pool entries from a random offset keep the dimension
+        # values distinct within each (date, app_name), like the API's top-N
+        pool_size = len(self.dimension_pool)
+        offsets = rng.integers(0, pool_size, groups)
+        dimension_indices = (
+            np.repeat(offsets, rows_per_day) + np.tile(np.arange(rows_per_day), groups)
+        ) % pool_size
+
+        columns = [
+            pa.array(date_column, type=pa.date32()),
+            pa.array(app_names, type=pa.string()).take(app_indices),
+            pa.array(values),
+            self.dimension_pool.take(dimension_indices),
+        ]
+        schema = BigqueryClient.get_arrow_schema(measure, dimension)
+        return pa.Table.from_arrays(columns[: len(schema)], schema=schema)
+
+    def batches(
+        self,
+        measures,
+        dimension,
+        app_names: list,
+        start_date: datetime,
+        end_date: datetime,
+        rows_per_day: int,
+        batch_days: int,
+    ):
+        windows = AnalyticsExport.get_date_windows(start_date, end_date, batch_days)
+        for window_start, window_end in windows:
+            for measure in measures:
+                yield measure, self.generate(
+                    measure,
+                    dimension,
+                    app_names,
+                    window_start,
+                    window_end,
+                    rows_per_day,
+                )
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import tempfile
+import threading
+from pathlib import Path
+
+# Parsed manifests by project, profile and parse-time vars
+_manifests = {}
+# Where dbt keeps the state it uses to only parse the files that changed
+PARTIAL_PARSE_FILE = "partial_parse.msgpack"
+# dbt keeps its invocation flags in global state, so invocations are serialized
+_lock = threading.Lock()
+
+
+class DbtRunError(Exception):
+    pass
+
+
+def get_selectors(source_name: str, tables) -> list:
+    """
+    Selectors for every model downstream of the given source tables
+    """
+    return [f"source:{source_name}.{table}+" for table in sorted(tables)]
+
+
+class InProcessDbt:
+    """
+    Invokes dbt through its Python API in this process instead of a `dbt`
+    subprocess.
+
+    Parsing the project is the bulk of dbt's startup, so the parsed manifest
+    is kept and reused by later invocations with the same project, profile
+    and `parse_vars`, the vars the project reads at parse time. Other vars,
+    such as the dates to transform, are only passed to the command, so they
+    do not invalidate the manifest.
+
+    Each container starts without the manifest, so dbt's partial parsing
+    state is also pulled from and pushed to `parse_storage`, a Prefect
+    storage block, when given. A container then only parses the files that
+    changed since the state was pushed.
+    """
+
+    def __init__(self, project_dir, profile: dict, parse_storage=None):
+        # `profile` has the layout of profiles.yml, as built by DbtCliProfile
+        self.project_dir = str(project_dir)
+        self.profile = profile
+        self.parse_storage = parse_storage
+
+    @property
+    def parse_state_path(self) -> Path:
+        return Path(self.project_dir) / "target" / PARTIAL_PARSE_FILE
+
+    def get_manifest_key(self, parse_vars: dict) -> str:
+        state = json.dumps([self.project_dir, self.profile, parse_vars], sort_keys=True)
+        return hashlib.sha256(state.encode()).hexdigest()
+
+    def invoke(self, command: list, dbt_vars: dict, parse_vars: dict | None = None):
+        from dbt.cli.main import dbtRunner
+
+        parse_vars = parse_vars or {}
+        key = self.get_manifest_key(parse_vars)
+        with _lock, tempfile.TemporaryDirectory() as profiles_dir:
+            self.write_profiles(profiles_dir)
+            flags = [
+                "--project-dir",
+                self.project_dir,
+                "--profiles-dir",
+                profiles_dir,
+            ]
+
+            manifest = _manifests.get(key)
+            if manifest is None:
+                pulled = self.pull_parse_state()
+                manifest = self.check(
+                    dbtRunner().invoke(
+                        ["parse", *flags, "--vars", json.dumps(parse_vars)]
+                    )
+                )
+                _manifests[key] = manifest
+                self.push_parse_state(pulled)
+
+            return self.check(
+                dbtRunner(manifest=manifest).invoke(
+                    [*command, *flags, "--vars", json.dumps(dbt_vars)]
+                )
+            )
+
+    def pull_parse_state(self) -> bytes | None:
+        """
+        Fetch the partial parsing state from `parse_storage`, unless the
+        project already has some, and return what the project starts with
+        """
+        path = self.parse_state_path
+        if self.parse_storage is not None and not path.exists():
+            try:
+                state = self.parse_storage.read_path(PARTIAL_PARSE_FILE)
+            except Exception as e:
+                print(f"No dbt parse state in storage, parsing in full: {e!r}")
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(state)
+        return path.read_bytes() if path.exists() else None
+
+    def push_parse_state(self, pulled: bytes | None):
+        """
+        Store the partial parsing state dbt left after parsing, when it
+        differs from the state the project started with
+        """
+        path = self.parse_state_path
+        if self.parse_storage is None or not path.exists():
+            return
+        state = path.read_bytes()
+        if state != pulled:
+            self.parse_storage.write_path(PARTIAL_PARSE_FILE, state)
+
+    def write_profiles(self, profiles_dir):
+        import yaml
+
+        with open(Path(profiles_dir) / "profiles.yml", "w") as f:
+            yaml.safe_dump(self.profile, f)
+
+    @staticmethod
+    def check(result):
+        if result.exception is not None:
+            raise DbtRunError(f"dbt failed: {result.exception!r}") from result.exception
+        if not result.success:
+            failed = [
+                f"{node_result.node.name}: {node_result.message}"
+                for node_result in getattr(result.result, "results", [])
+                if node_result.status in ("error", "fail")
+            ]
+            raise DbtRunError("dbt failed:\n" + "\n".join(failed))
+        return result.result
@@ -0,0 +1,136 @@
+import threading
+from datetime import date, datetime, time, timedelta, timezone
+
+from .stores import JsonStore
+
+
+def to_date(value) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+class WatermarkStore:
+    """
+    Tracks what has been exported for each (app_id, measure, dimension).
+
+    A watermark holds the disjoint ranges of dates that have been loaded, as
+    `[first, last]` pairs in date order, with the number of rows written by
+    the latest export. Exports only need to cover the requested dates outside
+    those ranges, plus the recent dates Apple may still revise.
+
+    Watermarks are recorded in memory as exports complete and persisted to
+    `store` with `save`, so a rerun after a partial failure resumes where it
+    stopped.
+    Shards of a sharded run do not persist them; they return what they
+    `recorded` for the parent run to replay and save.
+    """
+
+    def __init__(self, store: JsonStore):
+        self.store = store
+        self.watermarks = None
+        self.persist = True
+        # (key, start, end, rows) of every range recorded since `start_run`
+        self.recorded = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(app_id, measure, dimension) -> str:
+        return f"{app_id}/{measure}/{dimension}"
+
+    async def load(self):
+        if self.watermarks is None:
+            watermarks = await self.store.read() or {}
+            with self._lock:
+                if self.watermarks is None:
+                    self.watermarks = watermarks
+
+    async def save(self):
+        if not self.persist:
+            return
+        with self._lock:
+            watermarks = dict(self.watermarks or {})
+        await self.store.write(watermarks)
+
+    def start_run(self, persist: bool = True):
+        with self._lock:
+            self.persist = persist
+            self.recorded = []
+
+    def get(self, key) -> dict | None:
+        with self._lock:
+            return (self.watermarks or {}).get(key)
+
+    @staticmethod
+    def get_ranges(watermark: dict) -> list:
+        """
+        Loaded (first, last) date ranges of a watermark, in date order
+        """
+        return [
+            (date.fromisoformat(first), date.fromisoformat(last))
+            for first, last in watermark["ranges"]
+        ]
+
+    def plan(self, key, start_date, end_date, restate_from) -> list:
+        """
+        Date ranges between `start_date` and `end_date` still to be exported.
+
+        Dates from `restate_from` on are always exported again.
+        """
+        start, end = to_date(start_date), to_date(end_date)
+        ranges = [(start, end)]
+
+        watermark = self.get(key)
+        if watermark is not None:
+            one_day = timedelta(days=1)
+            restate_last = to_date(restate_from) - one_day
+            for first, last in self.get_ranges(watermark):
+                last = min(last, restate_last)
+                if first > last:
+                    continue
+                remaining = []
+                for range_start, range_end in ranges:
+                    if range_end < first or range_start > last:
+                        remaining.append((range_start, range_end))
+                        continue
+                    if range_start < first:
+                        remaining.append((range_start, first - one_day))
+                    if range_end > last:
+                        remaining.append((last + one_day, range_end))
+                ranges = remaining
+
+        return [
+            (datetime.combine(range_start, time()), datetime.combine(range_end, time()))
+            for range_start, range_end in ranges
+        ]
+
+    def record(self, key, start_date, end_date, rows: int):
+        start, end = to_date(start_date), to_date(end_date)
+        # Expected volume of later exports, used to balance shards
+        rows_per_day = round(rows / ((end - start).days + 1), 2)
+
+        with self._lock:
+            self.recorded.append((key, start.isoformat(), end.isoformat(), rows))
+            if self.watermarks is None:
+                self.watermarks = {}
+            watermark = self.watermarks.get(key)
+
+            # Loaded ranges the new one overlaps or touches are merged into
+            # it; the others are kept, so that a gap between them is exported
+            # later instead of dropping the older range
+            ranges = []
+            if watermark is not None:
+                one_day = timedelta(days=1)
+                for first, last in self.get_ranges(watermark):
+                    if first <= end + one_day and last >= start - one_day:
+                        start, end = min(start, first), max(end, last)
+                    else:
+                        ranges.append((first, last))
+            ranges = sorted([*ranges, (start, end)])
+
+            self.watermarks[key] = {
+                "ranges": [
+                    [first.isoformat(), last.isoformat()] for first, last in ranges
+                ],
+                "rows": rows,
+                "rows_per_day": rows_per_day,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from collections import Counter, defaultdict
+
+import pyarrow as pa
+
+from .metrics import RUN, current_app, metrics
+
+_writer = None
+
+
+class TableBuffer:
+    def __init__(self):
+        # (app_name, table) chunks waiting to be flushed
+        self.chunks = []
+        self.rows = 0
+        self.buffered_since = None
+        # Producers registered for the table that have not finished yet
+        self.producers = 0
+        # Chunks per app that are buffered or being flushed
+        self.pending = Counter()
+        self.callbacks = defaultdict(list)
+        self.failed = set()
+
+
+class CoalescingWriter:
+    """
+    Buffers the rows written for the same BigQuery table by every app export
+    and writes them together in a single load.
+
+    A table is flushed once every producer registered for it has called
+    `done`, when it has buffered `max_rows` rows, or when its oldest rows have
+    waited `max_delay` seconds. Each flush atomically replaces the rows of
+    exactly the apps and dates it contains.
+
+    Producers run on their own threads and event loops, so buffers are kept
+    under a thread lock and flushed on whichever loop triggers the flush.
+    """
+
+    def __init__(self, create_client, max_rows: int, max_delay: float):
+        # Async callable returning the BigqueryClient that flushes are written with
+        self.create_client = create_client
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.buffers = defaultdict(TableBuffer)
+        # Errors of failed flushes, keyed by app/measure/dimension
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def register(self, measure, dimension, producers: int = 1):
+        with self._lock:
+            self.buffers[(measure, dimension)].producers += producers
+
+    async def write(self, measure, dimension, app_name, table: pa.Table):
+        if not table.num_rows:
+            return
+
+        key = (measure, dimension)
+        with self._lock:
+            buffer = self.buffers[key]
+            buffer.chunks.append((app_name, table))
+            buffer.rows += table.num_rows
+            buffer.pending[app_name] += 1
+            if buffer.buffered_since is None:
+                buffer.buffered_since = time.monotonic()
+            full = buffer.rows >= self.max_rows
+
+        if full:
+            await self.flush(key)
+
+    async def done(self, measure, dimension, app_name, on_flushed=None):
+        """
+        Mark one producer of the table as finished. `on_flushed` is called
+        once every row the app wrote to the table has been flushed, and never
+        if one of its flushes failed.
+        """
+        key = (measure, dimension)
+        with self._lock:
+            buffer = self.buffers[key]
+            buffer.producers -= 1
+            ready = False
+            if on_flushed is not None and app_name not in buffer.failed:
+                if buffer.pending[app_name]:
+                    buffer.callbacks[app_name].append(on_flushed)
+                else:
+                    ready = True
+            flush = buffer.producers <= 0 and buffer.chunks
+
+        if ready:
+            on_flushed()
+        if flush:
+            await self.flush(key)
+
+    async def flush(self, key):
+        measure, dimension = key
+        with self._lock:
+            buffer = self.buffers[key]
+            chunks, buffer.chunks = buffer.chunks, []
+            buffer.rows = 0
+            buffer.buffered_since = None
+        if not chunks:
+            return
+
+        table = pa.concat_tables([chunk for _, chunk in chunks])
+        app_names = Counter(app_name for app_name, _ in chunks)
+        # The flush covers several apps; attribute its metrics to the run only
+        token = current_app.set(RUN)
+        try:
+            bq_client = await self.create_client()
+            await bq_client.create_table_if_not_exists(measure, dimension)
+            with metrics.timer("coalesced_flush"):
+                await bq_client.write_table(measure, dimension, table, overwrite=False)
+        except Exception as e:
+            print(f"Failed to write {measure} - {dimension}: {e!r}")
+            with self._lock:
+                for app_name, count in app_names.items():
+                    buffer.pending[app_name] -= count
+                    buffer.failed.add(app_name)
+                    buffer.callbacks.pop(app_name, None)
+                    self.failures[f"{app_name}/{measure}/{dimension}"] = repr(e)
+            return
+        finally:
+            current_app.reset(token)
+
+        metrics.incr("coalesced_flushes", app=RUN)
+        metrics.incr("coalesced_apps", len(app_names), app=RUN)
+
+        ready = []
+        with self._lock:
+            for app_name, count in app_names.items():
+                buffer.pending[app_name] -= count
+                if not buffer.pending[app_name] and app_name not in buffer.failed:
+                    ready.extend(buffer.callbacks.pop(app_name, []))
+        for on_flushed in ready:
+            on_flushed()
+
+    async def flush_all(self):
+        with self._lock:
+            keys = [key for key, buffer in self.buffers.items() if buffer.chunks]
+        await asyncio.gather(*[self.flush(key) for key in keys])
+
+    async def flush_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            keys = [
+                key
+                for key, buffer in self.buffers.items()
+                if buffer.buffered_since is not None
+                and now - buffer.buffered_since >= self.max_delay
+            ]
+        await asyncio.gather(*[self.flush(key) for key in keys])
+
+    async def flush_periodically(self, interval: float, stop: asyncio.Event):
+        # Stops between flushes so that none is interrupted halfway
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                await self.flush_expired()
+
+
+def set_writer(writer: CoalescingWriter | None):
+    global _writer
+    _writer = writer
+
+
+def get_writer() -> CoalescingWriter | None:
+    return _writer
@@ -1,89 +1,788 @@
-from datetime import datetime
+import asyncio
+import json
+import re
+import shlex
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
 
 from prefect import flow, task
-from prefect_dbt import DbtCliProfile, DbtCoreOperation
+from prefect.artifacts import create_markdown_artifact, create_table_artifact
+from prefect.blocks.system import Secret
 
-from analytics.bigquery import BigqueryClient
+from analytics.bigquery import ALL_MEASURES, BigqueryClient
+from analytics.cache import ResponseCache
 from analytics.client import AnalyticsClient
+from analytics.columns import MeasureColumns
+from analytics.concurrency import (
+    ConcurrencyController,
+    bounded,
+    get_run_limit,
+    set_controller,
+    set_run_limit,
+)
+from analytics.digests import DigestStore, set_digest_store
 from analytics.export import AnalyticsExport
+from analytics.metrics import current_app, metrics
+from analytics.session import SessionStore
+from analytics.sharding import (
+    SHARD_BACKENDS,
+    export_shard,
+    export_shards,
+    get_unit_dates,
+    make_unit,
+    plan_shards,
+)
+from analytics.stores import create_store
 from analytics.table_metadata import dimensions, metric_data
-from config import APPS, EXPORT_DATASET_ID, PROJECT_ID
+from analytics.transformations import InProcessDbt, get_selectors
+from analytics.watermarks import WatermarkStore
+from analytics.writer import CoalescingWriter, get_writer, set_writer
+from config import (
+    APP_STORE_CONCURRENCY,
+    APP_STORE_CONNECT_URL,
+    APP_STORE_PASSWORD_BLOCK,
+    APP_STORE_USERNAME_BLOCK,
+    APPLE_AUTH_URL,
+    APPS,
+    BACKFILL_WINDOW_DAYS,
+    BIGQUERY_DML_CONCURRENCY,
+    BIGQUERY_LOAD_CONCURRENCY,
+    COALESCE_MAX_DELAY,
+    COALESCE_MAX_ROWS,
+    COALESCE_WRITES,
+    DBT_EXECUTION,
+    DBT_PARSE_STORAGE,
+    DBT_PROFILE_BLOCK,
+    DBT_PROJECT_DIR,
+    DBT_THREADS,
+    DIGEST_BLOCK_NAME,
+    DIGEST_FILE,
+    DIGEST_RETENTION_DAYS,
+    DIGEST_STORE,
+    EXPORT_DATASET_ID,
+    EXPORT_GRANULARITY,
+    EXPORT_LAYOUT,
+    MAX_CONCURRENT_EXPORTS,
+    MAX_CONCURRENT_EXPORTS_PER_APP,
+    METRICS_OPENMETRICS_PATH,
+    PROJECT_ID,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_MUTABLE_DAYS,
+    RESPONSE_CACHE_TTL,
+    SESSION_BLOCK_NAME,
+    SESSION_FILE,
+    SESSION_STORE,
+    SHARD_BACKEND,
+    SHARD_DEFAULT_ROWS_PER_DAY,
+    SHARD_DEPLOYMENT,
+    SHARD_RESULT_STORAGE,
+    SHARD_WINDOW_DAYS,
+    SHARDS,
+    SKIP_UNCHANGED_WRITES,
+    WATERMARK_BLOCK_NAME,
+    WATERMARK_FILE,
+    WATERMARK_RESTATE_DAYS,
+    WATERMARK_STORE,
+)
+
+GRANULARITIES = ("metric", "dimension")
+LAYOUTS = ("measure", "wide")
+
+# Every app export in the process shares one App Store Connect session
+session_store = SessionStore(
+    create_store(SESSION_STORE, SESSION_FILE, SESSION_BLOCK_NAME, secret=True)
+)
+
+# Dates already exported, so that reruns only export what is missing
+watermark_store = WatermarkStore(
+    create_store(WATERMARK_STORE, WATERMARK_FILE, WATERMARK_BLOCK_NAME)
+)
+
+# Digests of the rows written to each slice, so that unchanged ones are skipped
+digest_store = DigestStore(
+    create_store(DIGEST_STORE, DIGEST_FILE, DIGEST_BLOCK_NAME), DIGEST_RETENTION_DAYS
+)
+
+# Shard runs of the deployment hand their results back through this storage;
+# with_options does not carry the flow's run name over
+export_shard = export_shard.with_options(
+    flow_run_name=export_shard.flow_run_name, result_storage=SHARD_RESULT_STORAGE
+)
+
+
+class ExportError(Exception):
+    def __init__(self, failures: dict):
+        self.failures = failures
+        details = "\n".join(f"{name}: {error}" for name, error in failures.items())
+        super().__init__(f"{len(failures)} export(s) failed:\n{details}")
+
+
+async def publish_metrics():
+    await create_table_artifact(
+        metrics.get_rows(),
+        key="export-performance",
+        description="Per-stage timings and counters, for the run and per app",
+    )
+    await create_markdown_artifact(
+        metrics.to_markdown(), key="export-performance-summary"
+    )
+
+    if METRICS_OPENMETRICS_PATH:
+        with open(METRICS_OPENMETRICS_PATH, "w") as f:
+            f.write(metrics.to_openmetrics())
+
+
+async def collect_failures(states: dict) -> dict:
+    return {
+        name: await state.result(raise_on_failure=False, fetch=True)
+        for name, state in states.items()
+        if not state.is_completed()
+    }
 
 
 @flow
-def app_store_analytics(start_date: datetime = datetime.today()):
-    for app_id, app_name in APPS:
-        app_export(app_id, app_name, start_date)
+async def app_store_analytics(
+    start_date: datetime = datetime.today(),
+    end_date: datetime | None = None,
+    concurrent: bool = True,
+    max_parallel_per_app: int = MAX_CONCURRENT_EXPORTS_PER_APP,
+    max_concurrency: int = MAX_CONCURRENT_EXPORTS,
+    bypass_cache: bool = False,
+    fake_data: bool = True,
+    full_refresh: bool = False,
+    granularity: str = EXPORT_GRANULARITY,
+    coalesce_writes: bool = COALESCE_WRITES,
+    dbt_threads: int = DBT_THREADS,
+    layout: str = EXPORT_LAYOUT,
+    skip_unchanged: bool = SKIP_UNCHANGED_WRITES,
+    shards: int = SHARDS,
+    shard_backend: str = SHARD_BACKEND,
+):
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity}, expected {GRANULARITIES}")
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, expected {LAYOUTS}")
+    if shard_backend not in SHARD_BACKENDS:
+        raise ValueError(
+            f"Unknown shard backend {shard_backend}, expected {SHARD_BACKENDS}"
+        )
+    if shards > 1 and shard_backend == "deployment" and SHARD_RESULT_STORAGE is None:
+        # Shard runs could not hand their results back to this run
+        raise ValueError(
+            "The deployment shard backend needs SHARD_RESULT_STORAGE in config.py"
+        )
+
+    end_date = end_date or start_date
+    options = {
+        "concurrent": concurrent,
+        "max_parallel_per_app": max_parallel_per_app,
+        "max_concurrency": max_concurrency,
+        "bypass_cache": bypass_cache,
+        "fake_data": fake_data,
+        "full_refresh": full_refresh,
+        "granularity": granularity,
+        "coalesce_writes": coalesce_writes,
+        "layout": layout,
+        "skip_unchanged": skip_unchanged,
+    }
+    await start_run(options, persist=True)
+
+    try:
+        if shards > 1:
+            shard_units = plan_shards(
+                APPS,
+                start_date,
+                end_date,
+                shards,
+                SHARD_WINDOW_DAYS,
+                partial(plan_export, full_refresh=full_refresh, layout=layout),
+                watermark_store,
+                SHARD_DEFAULT_ROWS_PER_DAY,
+            )
+            failures = await export_shards(
+                shard_units,
+                shard_backend,
+                SHARD_DEPLOYMENT,
+                options,
+                watermark_store,
+                digest_store,
+            )
+            if failures:
+                raise ExportError(failures)
+        else:
+            units = [
+                make_unit(app_id, app_name, start_date, end_date)
+                for app_id, app_name in APPS
+            ]
+            await export_apps(units, options)
+
+        # Only the models and partitions downstream of the slices written, by
+        # this run or by earlier runs whose transformation failed, need
+        # rebuilding; a full refresh rebuilds every model over its dates
+        pending = digest_store.get_pending()
+        dates = sorted(set().union(*pending.values()))
+        with metrics.timer("dbt_run"):
+            run_dbt(
+                start_date,
+                end_date,
+                None if full_refresh else sorted(pending),
+                dbt_threads,
+                layout,
+                None if full_refresh else [day.isoformat() for day in dates],
+            )
+
+        # Dates stay pending, and are transformed by the next run, until dbt
+        # has succeeded
+        if full_refresh:
+            pending = digest_store.get_pending(start_date, end_date)
+        digest_store.clear_pending(pending)
+        await digest_store.save()
+    finally:
+        await publish_metrics()
+
+
+async def start_run(options: dict, persist: bool):
+    set_run_limit(options["max_concurrency"])
+    set_controller(
+        ConcurrencyController.create(
+            app_store=APP_STORE_CONCURRENCY,
+            bigquery_load=BIGQUERY_LOAD_CONCURRENCY,
+            bigquery_dml=BIGQUERY_DML_CONCURRENCY,
+        )
+    )
+    metrics.reset()
+
+    await watermark_store.load()
+    watermark_store.start_run(persist)
+    # Digests are recorded even when writes are not skipped, so that they
+    # always describe what was last written
+    await digest_store.load()
+    digest_store.start_run(
+        options["skip_unchanged"] and not options["full_refresh"], persist
+    )
+    set_digest_store(digest_store)
+
+
+async def export_apps(units: list, options: dict):
+    full_refresh = options["full_refresh"]
+    layout = options["layout"]
+
+    writer = None
+    if options["coalesce_writes"]:
+        writer = CoalescingWriter(
+            lambda: BigqueryClient.create_client(PROJECT_ID, EXPORT_DATASET_ID),
+            max_rows=COALESCE_MAX_ROWS,
+            max_delay=COALESCE_MAX_DELAY,
+        )
+        # Every unit's planned exports are registered up front so that each
+        # table is only flushed once all of its producers have finished
+        await watermark_store.load()
+        for unit in units:
+            for metric, dimension in plan_export(
+                unit["app_id"],
+                *get_unit_dates(unit),
+                full_refresh,
+                layout,
+                unit["dimensions"],
+            ):
+                writer.register(metric, dimension)
+        stop_flushing = asyncio.Event()
+        flusher = asyncio.create_task(
+            writer.flush_periodically(COALESCE_MAX_DELAY / 4, stop_flushing)
+        )
+    set_writer(writer)
+
+    # Units are named after their app, and dates when an app has several
+    app_units = Counter(unit["app_name"] for unit in units)
+    exports = {
+        (
+            unit["app_name"]
+            if app_units[unit["app_name"]] == 1
+            else f"{unit['app_name']}/{unit['start_date']}"
+        ): app_export(
+            unit["app_id"],
+            unit["app_name"],
+            *get_unit_dates(unit),
+            options["max_parallel_per_app"],
+            options["bypass_cache"],
+            options["fake_data"],
+            full_refresh,
+            options["granularity"],
+            layout,
+            unit["dimensions"],
+            return_state=True,
+        )
+        for unit in units
+    }
+
+    try:
+        if options["concurrent"]:
+            states = dict(zip(exports, await asyncio.gather(*exports.values())))
+        else:
+            states = {app_name: await export for app_name, export in exports.items()}
+    finally:
+        if writer is not None:
+            stop_flushing.set()
+            await flusher
+            await writer.flush_all()
+            # Watermarks of coalesced writes are only recorded once flushed
+            await watermark_store.save()
+            await digest_store.save()
+            set_writer(None)
+
+    failures = await collect_failures(states)
+    if writer is not None:
+        failures.update(writer.failures)
+    if failures:
+        raise ExportError(failures)
 
-    run_dbt(start_date)
+
+def plan_export(
+    app_id, start_date, end_date, full_refresh, layout, export_dimensions=None
+) -> dict:
+    """
+    Date ranges to export for each (metric, dimension) of an app, over every
+    dimension or `export_dimensions`. In the wide layout every metric of a
+    dimension is exported together, as ALL_MEASURES.
+    """
+    restate_from = datetime.today() - timedelta(days=WATERMARK_RESTATE_DAYS)
+    plans = {}
+    for dimension in export_dimensions or dimensions:
+        for metric in get_layout_metrics(layout):
+            key = watermark_store.make_key(app_id, metric, dimension)
+            ranges = (
+                [(start_date, end_date)]
+                if full_refresh
+                else watermark_store.plan(key, start_date, end_date, restate_from)
+            )
+            if ranges:
+                plans[(metric, dimension)] = ranges
+    return plans
+
+
+def get_layout_metrics(layout) -> list:
+    return [ALL_MEASURES] if layout == "wide" else list(metric_data)
+
+
+def get_measures(metric) -> list:
+    """
+    Measures fetched to export a metric
+    """
+    return list(metric_data) if metric == ALL_MEASURES else [metric]
 
 
 @flow(flow_run_name="{app_name}-export")
-async def app_export(app_id: str, app_name: str, start_date: datetime):
-    client = AnalyticsClient()
-    analytics_export = AnalyticsExport(
-        client=client,
-        project=PROJECT_ID,
-        dataset=EXPORT_DATASET_ID,
-        app_id=app_id,
-        app_name=app_name,
+async def app_export(
+    app_id: str,
+    app_name: str,
+    start_date: datetime,
+    end_date: datetime | None = None,
+    max_parallel: int = MAX_CONCURRENT_EXPORTS_PER_APP,
+    bypass_cache: bool = False,
+    fake_data: bool = True,
+    full_refresh: bool = False,
+    granularity: str = EXPORT_GRANULARITY,
+    layout: str = EXPORT_LAYOUT,
+    export_dimensions: list | None = None,
+):
+    end_date = end_date or start_date
+    # Attributes the metrics recorded by this export and its tasks to the app
+    current_app.set(app_name)
+
+    await watermark_store.load()
+    plans = plan_export(
+        app_id, start_date, end_date, full_refresh, layout, export_dimensions
     )
+    expected = len(export_dimensions or dimensions) * len(get_layout_metrics(layout))
+    skipped = expected - len(plans)
+    if skipped:
+        metrics.incr("exports_skipped", skipped)
+    if not plans:
+        print(f"{app_name} is already exported, nothing to do")
+        return
 
-    for dimension in dimensions:
-        for metric, data in metric_data.items():
-            await start_export.submit(
-                analytics_export,
-                start_date,
-                app_name,
-                metric,
-                data,
-                dimension,
+    app_limit = asyncio.Semaphore(max_parallel)
+    run_limit = get_run_limit()
+    writer = get_writer()
+
+    async def finish_export(metric, dimension, loaded):
+        key = watermark_store.make_key(app_id, metric, dimension)
+
+        def record():
+            for range_start, range_end, rows in loaded:
+                watermark_store.record(key, range_start, range_end, rows)
+
+        if writer is None:
+            record()
+        else:
+            # Buffered rows only count as loaded once the writer flushes them
+            await writer.done(metric, dimension, app_name, on_flushed=record)
+
+    cache = ResponseCache(
+        RESPONSE_CACHE_DIR,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        mutable_days=RESPONSE_CACHE_MUTABLE_DAYS,
+        recent_ttl=RESPONSE_CACHE_TTL,
+        bypass=bypass_cache,
+    )
+
+    # One pooled HTTP client serves every request made during this export
+    async with AnalyticsClient(
+        cache=cache, base_url=APP_STORE_CONNECT_URL, auth_url=APPLE_AUTH_URL
+    ) as client:
+        if not fake_data:
+            username = await Secret.load(APP_STORE_USERNAME_BLOCK)
+            password = await Secret.load(APP_STORE_PASSWORD_BLOCK)
+            await client.authenticate(session_store, username.get(), password.get())
+
+        analytics_export = AnalyticsExport(
+            client=client,
+            project=PROJECT_ID,
+            dataset=EXPORT_DATASET_ID,
+            app_id=app_id,
+            app_name=app_name,
+        )
+
+        async def bounded_export(metric, dimension, ranges):
+            result = {"metric": metric, "dimension": dimension, "error": None}
+            loaded = []
+            try:
+                async with bounded(app_limit, run_limit):
+                    for range_start, range_end in ranges:
+                        state = await start_export(
+                            analytics_export,
+                            range_start,
+                            range_end,
+                            app_name,
+                            metric,
+                            dimension,
+                            fake_data,
+                            return_state=True,
+                        )
+                        if not state.is_completed():
+                            error = await state.result(
+                                raise_on_failure=False, fetch=True
+                            )
+                            result["error"] = repr(error)
+                            break
+                        rows = await state.result(fetch=True)
+                        loaded.append((range_start, range_end, rows))
+            finally:
+                await finish_export(metric, dimension, loaded)
+
+            return [{**result, "rows": sum(rows for _, _, rows in loaded)}]
+
+        async def bounded_dimension_export(dimension, metric_plans):
+            async with bounded(app_limit, run_limit):
+                state = await export_dimension(
+                    analytics_export,
+                    app_name,
+                    dimension,
+                    metric_plans,
+                    fake_data,
+                    return_state=True,
+                )
+            if state.is_completed():
+                metric_results = await state.result(fetch=True)
+            else:
+                error = await state.result(raise_on_failure=False, fetch=True)
+                metric_results = {
+                    metric: {"loaded": [], "error": repr(error)}
+                    for metric in metric_plans
+                }
+
+            await asyncio.gather(
+                *[
+                    finish_export(metric, dimension, result["loaded"])
+                    for metric, result in metric_results.items()
+                ]
             )
+            return [
+                {
+                    "metric": metric,
+                    "dimension": dimension,
+                    "rows": sum(rows for _, _, rows in result["loaded"]),
+                    "error": result["error"],
+                }
+                for metric, result in metric_results.items()
+            ]
+
+        if granularity == "dimension":
+            plans_by_dimension = {}
+            for (metric, dimension), ranges in plans.items():
+                plans_by_dimension.setdefault(dimension, {})[metric] = ranges
+            exports = [
+                bounded_dimension_export(dimension, metric_plans)
+                for dimension, metric_plans in plans_by_dimension.items()
+            ]
+        else:
+            exports = [
+                bounded_export(metric, dimension, ranges)
+                for (metric, dimension), ranges in plans.items()
+            ]
+
+        try:
+            results = [
+                result
+                for export_results in await asyncio.gather(*exports)
+                for result in export_results
+            ]
+        finally:
+            # Keep the progress of completed exports even if others failed
+            await watermark_store.save()
+            await digest_store.save()
+
+    await create_table_artifact(
+        results,
+        key=f"{artifact_slug(app_name)}-export-results",
+        description=f"Rows exported and errors per metric for {app_name}",
+    )
+
+    failures = {
+        f"{app_name}/{result['metric']}/{result['dimension']}": result["error"]
+        for result in results
+        if result["error"] is not None
+    }
+    if failures:
+        raise ExportError(failures)
+
+
+def artifact_slug(name: str) -> str:
+    # Artifact keys may only contain lowercase letters, numbers and dashes
+    return re.sub(r"[^a-z0-9-]+", "-", name.lower())
+
+
+async def export_metric(
+    analytics_export: AnalyticsExport,
+    bq_client: BigqueryClient,
+    app_name: str,
+    metric: str,
+    dimension: str,
+    start_date: datetime,
+    end_date: datetime,
+    columns_by_measure: dict | None = None,
+) -> int:
+    """
+    Write one metric's rows between `start_date` and `end_date`, taken from
+    fetched `columns_by_measure` or generated when it is None. ALL_MEASURES
+    writes every measure as one wide table.
+    """
+    if columns_by_measure is None:
+        # Generate a few rows of fake data per day
+        with metrics.timer("generate"):
+            tables = {
+                measure: get_synthetic_generator().generate(
+                    measure, dimension, [app_name], start_date, end_date, rows_per_day=3
+                )
+                for measure in get_measures(metric)
+            }
+    else:
+        tables = {
+            measure: (
+                columns_by_measure.get(measure) or MeasureColumns(measure)
+            ).to_arrow(app_name, dimension)
+            for measure in get_measures(metric)
+        }
+
+    if metric == ALL_MEASURES:
+        with metrics.timer("widen"):
+            table = BigqueryClient.to_wide_table(tables, dimension)
+    else:
+        table = tables[metric]
+
+    with metrics.timer("write"):
+        writer = get_writer()
+        if writer is not None:
+            await writer.write(metric, dimension, app_name, table)
+            return table.num_rows
+
+        return await analytics_export.write_table(
+            bq_client, metric, dimension, table, overwrite=False
+        )
 
 
 @task
 async def start_export(
     analytics_export: AnalyticsExport,
     start_date: datetime,
+    end_date: datetime,
     app_name: str,
     metric: str,
-    data: dict,
     dimension: str,
+    fake_data: bool = True,
 ):
     print(f"{metric} - {dimension}")
 
-    # Generate a few rows of fake data
-    rows = []
-    for i in range(0, 3):
-        rows.append(analytics_export._generate_fake_data(start_date, data, seed=i))
-
     bq_client = await BigqueryClient.create_client(PROJECT_ID, EXPORT_DATASET_ID)
 
-    data_by_date = {start_date.strftime("%Y-%m-%d"): rows}
+    columns_by_measure = None
+    if not fake_data:
+        with metrics.timer("fetch"):
+            columns_by_measure = await analytics_export.fetch_date_range(
+                dimension,
+                start_date,
+                end_date,
+                BACKFILL_WINDOW_DAYS,
+                measures=get_measures(metric),
+            )
 
-    await analytics_export.write_data(
+    return await export_metric(
+        analytics_export,
         bq_client,
         app_name,
         metric,
         dimension,
-        data_by_date,
-        overwrite=False,
+        start_date,
+        end_date,
+        columns_by_measure,
+    )
+
+
+@task(task_run_name="{dimension}")
+async def export_dimension(
+    analytics_export: AnalyticsExport,
+    app_name: str,
+    dimension: str,
+    metric_plans: dict,
+    fake_data: bool = True,
+) -> dict:
+    """
+    Export every planned metric of one dimension in a single task.
+
+    Metrics planned over the same date ranges are fetched together in batched
+    requests and written concurrently. A failing metric does not fail the
+    task; each metric's loaded ranges and error are returned instead.
+    """
+    print(f"{dimension}: {len(metric_plans)} metrics")
+
+    bq_client = await BigqueryClient.create_client(PROJECT_ID, EXPORT_DATASET_ID)
+    results = {metric: {"loaded": [], "error": None} for metric in metric_plans}
+
+    async def export_range(metric, range_start, range_end, columns_by_measure):
+        try:
+            rows = await export_metric(
+                analytics_export,
+                bq_client,
+                app_name,
+                metric,
+                dimension,
+                range_start,
+                range_end,
+                columns_by_measure,
+            )
+        except Exception as e:
+            results[metric]["error"] = repr(e)
+        else:
+            results[metric]["loaded"].append((range_start, range_end, rows))
+
+    async def export_group(ranges, group):
+        for range_start, range_end in ranges:
+            # Later ranges are skipped for metrics that already failed
+            pending = [metric for metric in group if results[metric]["error"] is None]
+            if not pending:
+                return
+
+            columns_by_measure = None
+            if not fake_data:
+                try:
+                    with metrics.timer("fetch"):
+                        columns_by_measure = await analytics_export.fetch_date_range(
+                            dimension,
+                            range_start,
+                            range_end,
+                            BACKFILL_WINDOW_DAYS,
+                            measures=[
+                                measure
+                                for metric in pending
+                                for measure in get_measures(metric)
+                            ],
+                        )
+                except Exception as e:
+                    for metric in pending:
+                        results[metric]["error"] = repr(e)
+                    return
+
+            await asyncio.gather(
+                *[
+                    export_range(metric, range_start, range_end, columns_by_measure)
+                    for metric in pending
+                ]
+            )
+
+    groups = {}
+    for metric, ranges in metric_plans.items():
+        groups.setdefault(tuple(ranges), []).append(metric)
+    await asyncio.gather(
+        *[export_group(ranges, group) for ranges, group in groups.items()]
     )
 
+    return results
+
+
+@lru_cache
+def get_synthetic_generator(seed: int = 0):
+    # Only fake data runs pay for importing numpy and faker
+    from analytics.synthetic import SyntheticDataGenerator
+
+    return SyntheticDataGenerator(seed)
+
 
 @task
-def run_dbt(start_date: datetime):
-    profile = DbtCliProfile.load("mozilla-demo")
+def run_dbt(
+    start_date: datetime,
+    end_date: datetime | None = None,
+    tables: list | None = None,
+    threads: int = DBT_THREADS,
+    layout: str = EXPORT_LAYOUT,
+    dates: list | None = None,
+):
+    """
+    Build the models downstream of the exported `tables`, or every model when
+    `tables` is None, reading the tables of the export `layout`. Only the
+    `dates` partitions are rebuilt when given, otherwise every date from
+    `start_date` to `end_date`.
+    """
+    # dbt is only needed once every export has finished
+    from prefect_dbt import DbtCliProfile, DbtCoreOperation
+
+    command = ["run", "--threads", str(threads)]
+    if tables is not None:
+        if not tables:
+            print("No tables were written, skipping dbt")
+            return
+        # The dbt sources are named after the dataset they are exported to
+        command += ["--select", *get_selectors(EXPORT_DATASET_ID, tables)]
+
+    profile = DbtCliProfile.load(DBT_PROFILE_BLOCK)
+    dbt_vars = {
+        "submission_date": start_date.strftime("%Y-%m-%d"),
+        "submission_end_date": (end_date or start_date).strftime("%Y-%m-%d"),
+        "export_layout": layout,
+    }
+    if dates is not None:
+        dbt_vars["submission_dates"] = dates
+
+    if DBT_EXECUTION == "in_process":
+        parse_storage = None
+        if DBT_PARSE_STORAGE is not None:
+            from prefect.blocks.core import Block
+
+            parse_storage = Block.load(DBT_PARSE_STORAGE)
+        # Only the layout changes what the project's models depend on
+        InProcessDbt(DBT_PROJECT_DIR, profile.get_profile(), parse_storage).invoke(
+            command, dbt_vars, parse_vars={"export_layout": layout}
+        )
+        return
 
     DbtCoreOperation(
-        commands=[
-            f"dbt run --vars '{{submission_date: {start_date.strftime('%Y-%m-%d')}'}}"
-        ],
-        project_dir="transformations",
+        commands=[f"dbt {shlex.join(command)} --vars '{json.dumps(dbt_vars)}'"],
+        project_dir=DBT_PROJECT_DIR,
         overwrite_profiles=True,
         dbt_cli_profile=profile,
     ).run()
 
 
 if __name__ == "__main__":
-    app_store_analytics()
+    asyncio.run(app_store_analytics())
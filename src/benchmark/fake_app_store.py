@@ -0,0 +1,167 @@
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .stats import BenchmarkStats
+
+
+class FakeAppStoreConnect:
+    """
+    Local stand-in for the App Store Connect login, session and time-series
+    endpoints, with configurable latency and injected 429 responses
+    """
+
+    def __init__(
+        self,
+        stats: BenchmarkStats,
+        latency: float = 0.05,
+        throttle_rate: float = 0.0,
+        retry_after: float = 0.1,
+        groups: int = 10,
+        seed: int = 0,
+    ):
+        self.stats = stats
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.groups = groups
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.get_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def should_throttle(self):
+        with self.random_lock:
+            return self.random.random() < self.throttle_rate
+
+    @staticmethod
+    def get_value(day, index, measure):
+        # Measures rank a dimension's groups differently
+        return (day.toordinal() * 31 + index * sum(map(ord, measure))) % 10000
+
+    def get_time_series(self, body):
+        start = date.fromisoformat(body["startTime"][:10])
+        end = date.fromisoformat(body["endTime"][:10])
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        group = body.get("group")
+
+        indices = [0]
+        if group:
+            # The top `limit` groups by their total of the ranking measure
+            indices = sorted(
+                range(self.groups),
+                key=lambda index: sum(
+                    self.get_value(day, index, group["metric"]) for day in days
+                ),
+                reverse=True,
+            )[: group["limit"]]
+
+        results = []
+        for index in indices:
+            results.append(
+                {
+                    "adamId": body["adamId"][0],
+                    "group": {
+                        "key": str(index),
+                        "title": f"{group['dimension']}-{index}",
+                    }
+                    if group
+                    else None,
+                    "data": [
+                        {
+                            "date": f"{day.isoformat()}T00:00:00Z",
+                            **{
+                                measure: self.get_value(day, index, measure)
+                                for measure in body["measures"]
+                            },
+                        }
+                        for day in days
+                    ],
+                }
+            )
+
+        return {"results": results, "size": len(results)}
+
+    def get_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, data, headers=None):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length)) if length else {}
+
+            def do_GET(self):
+                if self.path == "/olympus/v1/session":
+                    self.send_json(200, {}, {"Set-Cookie": "itctx=benchmark"})
+                elif self.path == "/analytics/api/v1/settings/all":
+                    self.send_json(200, {})
+                else:
+                    self.send_json(404, {"errors": [f"Unknown path {self.path}"]})
+
+            def do_POST(self):
+                body = self.read_json()
+                if self.path.startswith("/appleauth/auth/signin"):
+                    self.send_json(200, {}, {"Set-Cookie": "myacinfo=benchmark"})
+                elif self.path == "/analytics/api/v1/data/time-series":
+                    self.time_series(body)
+                else:
+                    self.send_json(404, {"errors": [f"Unknown path {self.path}"]})
+
+            def time_series(self, body):
+                with fake.stats.stage("app_store_request"):
+                    fake.stats.incr("app_store_requests")
+                    time.sleep(fake.latency)
+
+                    if fake.should_throttle():
+                        fake.stats.incr("app_store_throttled")
+                        self.send_json(
+                            429,
+                            {"errors": ["Too many requests"]},
+                            {"Retry-After": str(fake.retry_after)},
+                        )
+                        return
+
+                    self.send_json(200, fake.get_time_series(body))
+
+        return Handler
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+from analytics.bigquery import BigqueryClient
+from analytics.concurrency import get_controller
+from analytics.metrics import metrics
+
+from .stats import BenchmarkStats
+
+
+class FakeBigqueryApi:
+    """In-memory stand-in for the parts of `bigquery.Client` BigqueryClient uses"""
+
+    def __init__(self, project):
+        self.project = project
+        self.datasets = set()
+        self.tables = set()
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_dataset(self, dataset):
+        if str(dataset) not in self.datasets:
+            raise NotFound(str(dataset))
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.datasets.add(str(dataset))
+
+    def get_table(self, table):
+        if str(table) not in self.tables:
+            raise NotFound(str(table))
+
+    def create_table(self, table, exists_ok=False):
+        self.tables.add(f"{table.project}.{table.dataset_id}.{table.table_id}")
+
+    def delete_table(self, table, not_found_ok=False):
+        self.tables.discard(str(table))
+
+
+class FakeJob:
+    total_bytes_billed = 0
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def result(self):
+        time.sleep(self.latency)
+
+
+class FakeBigqueryClient(BigqueryClient):
+    """
+    BigqueryClient with the BigQuery API replaced by an in-process fake.
+
+    Everything up to issuing a job runs for real, including Parquet
+    serialization; load and DML jobs sleep for `job_latency` seconds instead.
+    Jobs are counted in the run's metrics like BigqueryClient counts them.
+    """
+
+    stats: BenchmarkStats = None
+    job_latency = 0.0
+
+    _clients = {}
+    _known_datasets = set()
+    _known_tables = set()
+
+    @classmethod
+    def get_client(cls, project):
+        with cls._lock:
+            if project not in cls._clients:
+                cls._clients[project] = FakeBigqueryApi(project)
+            return cls._clients[project]
+
+    @classmethod
+    async def create_client(cls, project_id, dataset_id):
+        with cls.stats.stage("bigquery_setup"):
+            return await super().create_client(project_id, dataset_id)
+
+    async def write_table(self, measure, dimension, table, overwrite):
+        with self.stats.stage("bigquery_write"):
+            return await super().write_table(measure, dimension, table, overwrite)
+
+    async def load_table(self, bq_client, destination, schema, table):
+        with self.stats.stage("bigquery_serialize"):
+            buffer = await asyncio.to_thread(BigqueryClient.to_parquet, table)
+
+        await self.run_job(
+            get_controller().bigquery_load, lambda: FakeJob(self.job_latency)
+        )
+        metrics.incr("bigquery_load_jobs")
+        metrics.incr("rows_serialized", table.num_rows)
+        metrics.incr("bytes_serialized", buffer.getbuffer().nbytes)
+
+    async def replace_slice(self, bq_client, table_fqid, staging_fqid, slices):
+        await self.run_job(
+            get_controller().bigquery_dml, lambda: FakeJob(self.job_latency)
+        )
+        metrics.incr("bigquery_dml_jobs")
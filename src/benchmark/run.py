@@ -0,0 +1,307 @@
+"""
+End-to-end benchmark of the export pipeline against local stand-ins for
+App Store Connect and BigQuery. Run from `src/`:
+
+    python -m benchmark.run --apps 6 --dimensions 1 --days 1 --output result.json
+
+Results are written as JSON tagged with the current git commit; pass an
+earlier result as `--baseline` to print the change in each metric.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+
+from analytics.metrics import RUN
+from analytics.table_metadata import metric_data
+
+from .fake_app_store import FakeAppStoreConnect
+from .fake_bigquery import FakeBigqueryClient
+from .stats import BenchmarkStats
+
+# Every dimension the API supports, including those not yet exported
+DIMENSIONS = [
+    "app_referrer",
+    "app_version",
+    "campaign",
+    "platform",
+    "platform_version",
+    "region",
+    "source",
+    "storefront",
+    "web_referrer",
+]
+
+COMPARED_METRICS = [
+    "wall_time",
+    "requests_per_sec",
+    "rows_per_sec",
+    "app_store_requests",
+    "load_jobs",
+    "dml_jobs",
+]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--apps", type=int, default=6)
+    parser.add_argument("--metrics", type=int, default=len(metric_data))
+    parser.add_argument("--dimensions", type=int, default=1)
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--start-date", default="2024-01-01")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="App Store response latency (s)"
+    )
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="Fraction of 429 responses"
+    )
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument(
+        "--job-latency", type=float, default=0.5, help="BigQuery job latency (s)"
+    )
+    parser.add_argument("--granularity", default=None)
+    parser.add_argument("--layout", default=None)
+    parser.add_argument(
+        "--coalesce-writes", action=argparse.BooleanOptionalAction, default=None
+    )
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="Export in this many shards, each in its own process",
+    )
+    parser.add_argument(
+        "--reruns",
+        type=int,
+        default=0,
+        help="Export the same dates again, as a daily run restating them, and "
+        "report the last run",
+    )
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--baseline", type=Path, default=None)
+    return parser.parse_args(args)
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def patched(module, **attributes):
+    original = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(module, name, value)
+
+
+def get_patches(args, workdir: Path, server_url: str) -> dict:
+    """
+    Attributes of `app_store_analytics` replaced for the benchmark, in this
+    process and in every shard process
+    """
+    from analytics.digests import DigestStore
+    from analytics.session import SessionStore
+    from analytics.stores import FileJsonStore
+    from analytics.watermarks import WatermarkStore
+
+    return {
+        "APPS": [(str(1000000 + i), f"app_{i}") for i in range(args.apps)],
+        "dimensions": DIMENSIONS[: args.dimensions],
+        "metric_data": dict(islice(metric_data.items(), args.metrics)),
+        "BigqueryClient": FakeBigqueryClient,
+        "APP_STORE_CONNECT_URL": server_url,
+        "APPLE_AUTH_URL": f"{server_url}/appleauth/auth",
+        "RESPONSE_CACHE_DIR": str(workdir / "cache"),
+        "session_store": SessionStore(
+            FileJsonStore(workdir / "session.json", private=True)
+        ),
+        "watermark_store": WatermarkStore(FileJsonStore(workdir / "watermarks.json")),
+        "digest_store": DigestStore(
+            FileJsonStore(workdir / "digests.json"), retention_days=35
+        ),
+    }
+
+
+def init_shard_process(args, workdir: Path, server_url: str):
+    # Every process running an ephemeral Prefect API would write to the same
+    # SQLite database, which does not take concurrent writers. Each starts
+    # from a copy of the parent's, already migrated and holding its blocks.
+    home = workdir / f"shard-{os.getpid()}"
+    home.mkdir()
+    with closing(sqlite3.connect(workdir / "prefect.db")) as source, closing(
+        sqlite3.connect(home / "prefect.db")
+    ) as target:
+        source.backup(target)
+    os.environ["PREFECT_HOME"] = str(home)
+
+    import app_store_analytics as pipeline
+
+    # Stages timed in shard processes are not reported
+    FakeBigqueryClient.stats = BenchmarkStats()
+    FakeBigqueryClient.job_latency = args.job_latency
+    for name, value in get_patches(args, workdir, server_url).items():
+        setattr(pipeline, name, value)
+
+
+async def run_benchmark(args, workdir: Path):
+    # Imported here so that Prefect picks up the isolated PREFECT_HOME
+    from prefect import task
+    from prefect.blocks.system import Secret
+
+    import app_store_analytics as pipeline
+    from analytics import sharding
+    from analytics.stores import FileJsonStore
+    from analytics.watermarks import WatermarkStore
+
+    stats = BenchmarkStats()
+    FakeBigqueryClient.stats = stats
+    FakeBigqueryClient.job_latency = args.job_latency
+
+    @task(name="run_dbt")
+    def skip_dbt(*args, **kwargs):
+        pass
+
+    start_date = datetime.fromisoformat(args.start_date)
+    end_date = start_date + timedelta(days=args.days - 1)
+
+    with FakeAppStoreConnect(
+        stats,
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+    ) as server:
+        await Secret(value="benchmark").save(
+            pipeline.APP_STORE_USERNAME_BLOCK, overwrite=True
+        )
+        await Secret(value="benchmark").save(
+            pipeline.APP_STORE_PASSWORD_BLOCK, overwrite=True
+        )
+
+        def create_shard_pool(workers):
+            return ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_shard_process,
+                initargs=(args, workdir, server.url),
+            )
+
+        with patched(
+            pipeline, **get_patches(args, workdir, server.url), run_dbt=skip_dbt
+        ), patched(sharding, create_shard_pool=create_shard_pool):
+            flow_args = {}
+            if args.max_concurrency:
+                flow_args["max_concurrency"] = args.max_concurrency
+            if args.granularity:
+                flow_args["granularity"] = args.granularity
+            if args.layout:
+                flow_args["layout"] = args.layout
+            if args.coalesce_writes is not None:
+                flow_args["coalesce_writes"] = args.coalesce_writes
+            if args.shards:
+                flow_args["shards"] = args.shards
+                flow_args["shard_backend"] = "process"
+
+            for run in range(args.reruns + 1):
+                if run:
+                    # Forget the exported dates so that they are all restated
+                    stats.reset()
+                    pipeline.watermark_store = WatermarkStore(
+                        FileJsonStore(workdir / f"watermarks-{run}.json")
+                    )
+
+                start = perf_counter()
+                await pipeline.app_store_analytics(
+                    start_date=start_date,
+                    end_date=end_date,
+                    fake_data=False,
+                    bypass_cache=True,
+                    **flow_args,
+                )
+                wall_time = perf_counter() - start
+
+            # Shard processes report their BigQuery jobs through the run's
+            # metrics, which the flow merges
+            run_counters = {
+                name: value
+                for (app, name), value in pipeline.metrics.counters.items()
+                if app == RUN
+            }
+
+    collected = stats.to_dict()
+    counters = collected["counters"]
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+        },
+        "wall_time": wall_time,
+        "app_store_requests": counters.get("app_store_requests", 0),
+        "app_store_throttled": counters.get("app_store_throttled", 0),
+        "requests_per_sec": counters.get("app_store_requests", 0) / wall_time,
+        "rows_loaded": run_counters.get("rows_serialized", 0),
+        "rows_per_sec": run_counters.get("rows_serialized", 0) / wall_time,
+        "bytes_loaded": run_counters.get("bytes_serialized", 0),
+        "load_jobs": run_counters.get("bigquery_load_jobs", 0),
+        "dml_jobs": run_counters.get("bigquery_dml_jobs", 0),
+        "stages": collected["stages"],
+    }
+
+
+def compare(result, baseline):
+    lines = [f"Compared to {baseline.get('commit')} ({baseline.get('timestamp')}):"]
+    for metric in COMPARED_METRICS:
+        before, after = baseline.get(metric), result.get(metric)
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        lines.append(f"  {metric}: {before:.2f} -> {after:.2f} ({change:+.1f}%)")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep benchmark runs, blocks and flow runs out of the real Prefect API
+        os.environ["PREFECT_HOME"] = workdir
+        os.environ.pop("PREFECT_API_URL", None)
+        os.environ.pop("PREFECT_API_KEY", None)
+
+        result = asyncio.run(run_benchmark(args, Path(workdir)))
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    print(output)
+
+    if args.baseline:
+        print(compare(result, json.loads(args.baseline.read_text())))
+
+
+if __name__ == "__main__":
+    main()
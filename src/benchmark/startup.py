@@ -0,0 +1,160 @@
+"""
+Startup profile of the flow's entrypoint, as paid by every Cloud Run cold
+start. Run from `src/`:
+
+    python -m benchmark.startup --output startup.json
+
+Imports `app_store_analytics` in a fresh interpreter with `-X importtime`
+and reports the import time of each of its direct imports and of each
+top-level package, then the cost of the dependencies that are only loaded
+on first use and of initializing the objects a run creates first. Pass an
+earlier result as `--baseline` to print the change in each timing.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .run import get_commit
+
+ENTRYPOINT = "app_store_analytics"
+
+# Loaded lazily by the subsystem that needs them
+DEFERRED_IMPORTS = [
+    "prefect_dbt",
+    "dbt.cli.main",
+    "analytics.synthetic",
+]
+
+PROFILE_SCRIPT = f"""
+import json
+from time import perf_counter
+
+start = perf_counter()
+import {ENTRYPOINT}
+timings = {{"entrypoint": perf_counter() - start}}
+
+deferred = {{}}
+for module in {DEFERRED_IMPORTS!r}:
+    start = perf_counter()
+    __import__(module)
+    deferred[module] = perf_counter() - start
+
+initialization = {{}}
+start = perf_counter()
+from analytics.client import AnalyticsClient
+AnalyticsClient()
+initialization["analytics_client"] = perf_counter() - start
+
+start = perf_counter()
+{ENTRYPOINT}.get_synthetic_generator()
+initialization["synthetic_generator"] = perf_counter() - start
+
+print(json.dumps({{**timings, "deferred": deferred, "initialization": initialization}}))
+"""
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--top", type=int, default=15, help="Modules and packages to report"
+    )
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--baseline", type=Path, default=None)
+    return parser.parse_args(args)
+
+
+def parse_importtime(stderr: str):
+    """
+    Cumulative seconds of the entrypoint's direct imports, and self seconds
+    summed per top-level package, from `-X importtime` output up to and
+    including the entrypoint
+    """
+    direct, packages = {}, Counter()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # Header line
+            continue
+
+        # Each level of nesting is indented by two more spaces, and modules
+        # are listed after everything they import
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        module = name.strip()
+        packages[module.split(".")[0]] += int(self_us) / 1e6
+        if depth == 1:
+            direct[module] = int(cumulative_us) / 1e6
+        elif depth == 0:
+            if module == ENTRYPOINT:
+                break
+            direct = {}
+
+    return direct, packages
+
+
+def profile_startup(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        # Importing prefect must not touch the real Prefect home or API
+        env = {**os.environ, "PREFECT_HOME": workdir}
+        env.pop("PREFECT_API_URL", None)
+        env.pop("PREFECT_API_KEY", None)
+
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", PROFILE_SCRIPT],
+            capture_output=True,
+            text=True,
+            env=env,
+            check=True,
+        )
+
+    timings = json.loads(process.stdout.strip().splitlines()[-1])
+    direct, packages = parse_importtime(process.stderr)
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "entrypoint": timings["entrypoint"],
+        "imports": dict(sorted(direct.items(), key=lambda item: -item[1])[: args.top]),
+        "packages": dict(packages.most_common(args.top)),
+        "deferred": timings["deferred"],
+        "initialization": timings["initialization"],
+    }
+
+
+def compare(result, baseline):
+    lines = [f"Compared to {baseline.get('commit')} ({baseline.get('timestamp')}):"]
+    pairs = [("entrypoint", baseline.get("entrypoint"), result["entrypoint"])]
+    for section in ("deferred", "initialization"):
+        for name, after in result[section].items():
+            pairs.append((name, baseline.get(section, {}).get(name), after))
+
+    for name, before, after in pairs:
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        lines.append(f"  {name}: {before:.3f}s -> {after:.3f}s ({change:+.1f}%)")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = profile_startup(args)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    print(output)
+
+    if args.baseline:
+        print(compare(result, json.loads(args.baseline.read_text())))
+
+
+if __name__ == "__main__":
+    main()
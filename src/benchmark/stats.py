@@ -0,0 +1,63 @@
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class Stage:
+    def __init__(self):
+        self.calls = 0
+        self.busy_time = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "busy_time": self.busy_time,
+            # Time from the first call starting to the last call finishing
+            "wall_time": (self.last_end - self.first_start) if self.calls else 0.0,
+        }
+
+
+class BenchmarkStats:
+    """Thread-safe counters and per-stage timings collected during a run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.stages = defaultdict(Stage)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.stages.clear()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            with self.lock:
+                stage = self.stages[name]
+                stage.calls += 1
+                stage.busy_time += end - start
+                if stage.first_start is None or start < stage.first_start:
+                    stage.first_start = start
+                if stage.last_end is None or end > stage.last_end:
+                    stage.last_end = end
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {
+                    name: stage.to_dict() for name, stage in self.stages.items()
+                },
+            }
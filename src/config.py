@@ -1,3 +1,8 @@
+from datetime import timedelta
+
+APP_STORE_CONNECT_URL = "https://appstoreconnect.apple.com"
+APPLE_AUTH_URL = "https://idmsa.apple.com/appleauth/auth"
+
 PROJECT_ID = "prefect-sbx-sales-engineering"
 EXPORT_DATASET_ID = "apple_app_store_exported"
 
@@ -9,3 +14,105 @@ APPS = [
     ("1073435754", "Klar"),
     ("1055677337", "Focus"),
 ]
+
+# Concurrent start_export tasks allowed per app, and across the whole run
+MAX_CONCURRENT_EXPORTS_PER_APP = 14
+MAX_CONCURRENT_EXPORTS = 50
+
+# Run-wide (initial, maximum) concurrent calls to App Store Connect, BigQuery
+# load jobs and BigQuery DML. Each budget halves when throttled and ramps back
+# up towards its maximum as calls succeed.
+APP_STORE_CONCURRENCY = (16, 64)
+# bigquery has a 100 concurrent request limit per method per user
+BIGQUERY_LOAD_CONCURRENCY = (25, 90)
+BIGQUERY_DML_CONCURRENCY = (10, 20)
+
+# Prefect tasks per app export: "dimension" runs one task per dimension that
+# exports all of its metrics, keeping orchestration overhead flat as dimensions
+# are added; "metric" runs one task per (metric, dimension)
+EXPORT_GRANULARITY = "dimension"
+
+# BigQuery tables exported to: "measure" writes one table per (measure,
+# dimension); "wide" writes one table per dimension with a column per measure,
+# so dbt models project it instead of joining a table per measure
+EXPORT_LAYOUT = "measure"
+
+# Buffer the rows every app export writes to the same BigQuery table and write
+# them in one load job once all apps have produced them, or earlier when a
+# table has buffered COALESCE_MAX_ROWS rows or for COALESCE_MAX_DELAY seconds
+COALESCE_WRITES = True
+COALESCE_MAX_ROWS = 1_000_000
+COALESCE_MAX_DELAY = 300
+
+# Days per App Store Connect time-series request when exporting a date range
+BACKFILL_WINDOW_DAYS = 30
+
+# On-disk App Store Connect response cache. Responses covering the last
+# RESPONSE_CACHE_MUTABLE_DAYS days can still be revised and expire after
+# RESPONSE_CACHE_TTL; older responses are kept until evicted.
+RESPONSE_CACHE_DIR = ".cache/app_store_connect"
+RESPONSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RESPONSE_CACHE_MUTABLE_DAYS = 3
+RESPONSE_CACHE_TTL = timedelta(hours=6)
+
+# App Store Connect credentials, stored as Prefect Secret blocks
+APP_STORE_USERNAME_BLOCK = "app-store-connect-username"
+APP_STORE_PASSWORD_BLOCK = "app-store-connect-password"
+
+# Where the authenticated App Store Connect session is persisted between runs:
+# "block" keeps it in the SESSION_BLOCK_NAME Secret block, which outlives the
+# Cloud Run container; "file" keeps it in SESSION_FILE for local runs
+SESSION_STORE = "block"
+SESSION_FILE = ".cache/app_store_connect_session.json"
+SESSION_BLOCK_NAME = "app-store-connect-session"
+
+# Where the dates already exported for each (app, measure, dimension) are
+# tracked, with the same "block" and "file" options as the session. Dates in
+# the last WATERMARK_RESTATE_DAYS days may still be revised by Apple and are
+# always exported again.
+WATERMARK_STORE = "block"
+WATERMARK_FILE = ".cache/export_watermarks.json"
+WATERMARK_BLOCK_NAME = "app-store-export-watermarks"
+WATERMARK_RESTATE_DAYS = 3
+
+# Digests of the rows last written to each (table, date, app_name) slice, kept
+# for DIGEST_RETENTION_DAYS days with the same "block" and "file" options as
+# the watermarks. Writes of slices whose rows have not changed are skipped,
+# and dbt only rebuilds the partitions of the dates that were written.
+SKIP_UNCHANGED_WRITES = True
+DIGEST_STORE = "block"
+DIGEST_FILE = ".cache/slice_digests.json"
+DIGEST_BLOCK_NAME = "app-store-export-digests"
+DIGEST_RETENTION_DAYS = 35
+
+# Large backfills can be split into SHARDS shards exported in parallel. The
+# work grid is divided into units of one app and dimension over at most
+# SHARD_WINDOW_DAYS days, weighed by the rows per day the watermarks recorded
+# for them (SHARD_DEFAULT_ROWS_PER_DAY when unknown) and balanced across the
+# shards. "deployment" runs each shard as a run of SHARD_DEPLOYMENT, whose
+# results must be persisted to storage the parent run can read, such as a GCS
+# bucket block named by SHARD_RESULT_STORAGE; "process" runs each shard in a
+# local process.
+SHARDS = 1
+SHARD_BACKEND = "deployment"
+SHARD_DEPLOYMENT = "export-shard/mozilla-example-shard"
+SHARD_RESULT_STORAGE = None
+SHARD_WINDOW_DAYS = 30
+SHARD_DEFAULT_ROWS_PER_DAY = 10
+
+# Per-stage timings and counters are published as Prefect artifacts after
+# every run; set a path to also write them in OpenMetrics text format
+METRICS_OPENMETRICS_PATH = None
+
+# How run_dbt invokes dbt: "in_process" calls dbt's Python API and reuses the
+# parsed manifest between invocations; "cli" runs `dbt run` in a subprocess
+# through prefect-dbt. Either way only the models downstream of the tables
+# written by the run are built, DBT_THREADS at a time.
+DBT_EXECUTION = "in_process"
+DBT_THREADS = 8
+DBT_PROJECT_DIR = "transformations"
+DBT_PROFILE_BLOCK = "mozilla-demo"
+# In-process dbt pulls and pushes its partial parsing state to this Prefect
+# storage block (such as "gcs-bucket/<name>"), so that a new container only
+# parses the files that changed instead of the whole project
+DBT_PARSE_STORAGE = None
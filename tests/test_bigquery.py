@@ -0,0 +1,66 @@
+import pytest
+from google.api_core.exceptions import BadRequest, Forbidden
+
+from analytics.bigquery import BigqueryClient
+from analytics.concurrency import AdaptiveLimiter
+
+CONFLICT = "Could not serialize access to table p:d.t due to concurrent update"
+
+
+class FakeJob:
+    def __init__(self, error=None):
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.fixture
+def client():
+    # Jobs are submitted by the tests, so no BigQuery client is needed
+    client = BigqueryClient.__new__(BigqueryClient)
+    client.job_backoff_base = 0
+    return client
+
+
+def submit_jobs(*errors):
+    jobs = [FakeJob(error) for error in errors]
+
+    def submit():
+        return jobs.pop(0)
+
+    return submit
+
+
+async def test_run_job_retries_concurrent_update(client):
+    limiter = AdaptiveLimiter("test", initial=2, maximum=2)
+    job = await client.run_job(limiter, submit_jobs(BadRequest(CONFLICT), None))
+
+    assert job.error is None
+    # Conflicts are not throttling, so the limit is not reduced
+    assert limiter.last_decrease == float("-inf")
+
+
+async def test_run_job_retries_quota_error(client):
+    limiter = AdaptiveLimiter("test", initial=2, maximum=2)
+    quota_error = Forbidden("quota", errors=[{"reason": "quotaExceeded"}])
+    job = await client.run_job(limiter, submit_jobs(quota_error, None))
+
+    assert job.error is None
+    assert limiter.last_decrease > float("-inf")
+
+
+async def test_run_job_raises_other_errors(client):
+    limiter = AdaptiveLimiter("test", initial=2, maximum=2)
+    with pytest.raises(BadRequest):
+        await client.run_job(limiter, submit_jobs(BadRequest("Syntax error"), None))
+
+
+async def test_run_job_gives_up_after_retries(client):
+    client.max_job_retries = 1
+    limiter = AdaptiveLimiter("test", initial=2, maximum=2)
+    with pytest.raises(BadRequest):
+        await client.run_job(
+            limiter, submit_jobs(BadRequest(CONFLICT), BadRequest(CONFLICT))
+        )
@@ -0,0 +1,76 @@
+import os
+from datetime import date, timedelta
+
+import pytest
+
+from analytics.cache import ResponseCache
+
+TTL = timedelta(hours=6)
+BODY = b"x" * 1000
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(tmp_path, max_bytes=10_000, mutable_days=3, recent_ttl=TTL)
+
+
+def write(cache, key, ttl=None, age=0):
+    with cache.writer(key, ttl) as f:
+        f.write(BODY)
+    # Entries are evicted least recently used first
+    path = cache.get_path(key)
+    accessed = path.stat().st_mtime - age
+    os.utime(path, (accessed, accessed))
+    return path
+
+
+def make_key(n) -> str:
+    return ResponseCache.make_key(n=n)
+
+
+def test_ttl_of_recent_dates(cache):
+    assert cache.get_ttl(date.today()) == TTL
+    assert cache.get_ttl((date.today() - timedelta(days=3)).isoformat()) == TTL
+    assert cache.get_ttl(None) == TTL
+
+
+def test_old_dates_never_expire(cache):
+    assert cache.get_ttl(date.today() - timedelta(days=4)) is None
+
+
+def test_hit(cache):
+    write(cache, make_key(0), ttl=TTL)
+
+    with cache.open(make_key(0)) as f:
+        assert f.read() == BODY
+
+
+def test_expired_entry_is_deleted(cache):
+    path = write(cache, make_key(0), ttl=timedelta(seconds=-1))
+
+    assert cache.open(make_key(0)) is None
+    assert not path.exists()
+
+
+def test_failed_write_is_not_stored(cache):
+    with pytest.raises(RuntimeError):
+        with cache.writer(make_key(0), None) as f:
+            f.write(BODY)
+            raise RuntimeError("body cut off")
+
+    assert cache.open(make_key(0)) is None
+    assert not list(cache.directory.glob("*/*"))
+
+
+def test_evicts_least_recently_used_down_to_90_percent(cache):
+    # Each entry is a little over 1000 bytes with its header
+    paths = [write(cache, make_key(n), age=100 - n) for n in range(9)]
+    assert cache.get_size() <= cache.max_bytes
+    # Reading the oldest entry makes it the most recently used
+    cache.open(make_key(0)).close()
+
+    paths.append(write(cache, make_key(9)))
+
+    assert cache.get_size() <= cache.max_bytes * 0.9
+    assert [path.exists() for path in paths[:3]] == [True, False, False]
+    assert all(path.exists() for path in paths[3:])
@@ -0,0 +1,106 @@
+import json
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+
+from analytics.client import AnalyticsClient
+
+
+def throttled(retry_after: str) -> httpx.Response:
+    return httpx.Response(429, headers={"retry-after": retry_after})
+
+
+@pytest.fixture
+def client():
+    return AnalyticsClient(backoff_base=1, backoff_max=8)
+
+
+def test_retry_after_seconds(client):
+    assert client.get_retry_delay(0, throttled("5")) == 5
+
+
+def test_retry_after_date(client):
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    delay = client.get_retry_delay(0, throttled(format_datetime(retry_at, True)))
+    assert 25 < delay <= 30
+
+
+def test_retry_after_date_without_zone(client):
+    # "-0000" parses to a naive datetime, read as UTC
+    assert client.get_retry_delay(0, throttled("Wed, 21 Oct 2015 07:28:00 -0000")) == 0
+
+
+@pytest.mark.parametrize("retry_after", ["soon", "Wed, 99 Foo"])
+def test_malformed_retry_after_backs_off(client, retry_after):
+    assert 0 <= client.get_retry_delay(3, throttled(retry_after)) <= 8
+
+
+# Groups of the fake time-series endpoint, ranked in opposite orders by the
+# two measures
+MEASURES = ("sales", "units")
+GROUPS = {"g0": (5, 1), "g1": (4, 2), "g2": (3, 3), "g3": (2, 4), "g4": (1, 5)}
+
+
+def time_series(requests: list):
+    def handle(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        requests.append(body)
+        group = body["group"]
+        index = MEASURES.index(group["metric"])
+        ranked = sorted(GROUPS.items(), key=lambda item: -item[1][index])
+        results = [
+            {
+                "group": {"key": title, "title": title},
+                "data": [
+                    {
+                        "date": "2024-01-01T00:00:00Z",
+                        **{
+                            measure: values[MEASURES.index(measure)]
+                            for measure in body["measures"]
+                        },
+                    }
+                ],
+            }
+            for title, values in ranked[: group["limit"]]
+        ]
+        return httpx.Response(200, json={"results": results})
+
+    return handle
+
+
+async def get_metrics(requests: list, max_groups_per_request: int) -> dict:
+    client = AnalyticsClient()
+    client.http = httpx.AsyncClient(
+        transport=httpx.MockTransport(time_series(requests))
+    )
+    client.group_limit = 2
+    client.max_groups_per_request = max_groups_per_request
+    async with client:
+        return await client.get_metrics(
+            "1", list(MEASURES), "source", "2024-01-01", "2024-01-01"
+        )
+
+
+async def test_batch_keeps_each_measure_top_groups():
+    requests = []
+    columns = await get_metrics(requests, max_groups_per_request=10)
+
+    assert [request["measures"] for request in requests] == [["sales", "units"]]
+    assert columns["sales"].dimension_values == ["g0", "g1"]
+    assert columns["units"].dimension_values == ["g4", "g3"]
+
+
+async def test_truncated_batch_refetches_other_measures():
+    requests = []
+    columns = await get_metrics(requests, max_groups_per_request=3)
+
+    # The batch only held the top 3 groups by sales
+    assert [request["measures"] for request in requests] == [
+        ["sales", "units"],
+        ["units"],
+    ]
+    assert requests[1]["group"]["limit"] == 2
+    assert columns["sales"].dimension_values == ["g0", "g1"]
+    assert columns["units"].dimension_values == ["g4", "g3"]
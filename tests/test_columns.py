@@ -0,0 +1,52 @@
+import io
+import json
+
+from analytics.columns import GroupedColumns
+
+# Ranked in opposite orders by the two measures
+VALUES = {"g0": (5, 1), "g1": (4, 2), "g2": (3, 3), "g3": (2, 4), "g4": (1, 5)}
+
+
+def make_result(title, sales, units) -> dict:
+    return {
+        "group": {"key": title, "title": title},
+        "data": [
+            {"date": "2024-01-01T00:00:00Z", "sales": sales, "units": units},
+            {"date": "2024-01-02T00:00:00Z", "sales": sales, "units": units},
+        ],
+    }
+
+
+def make_grouped() -> GroupedColumns:
+    grouped = GroupedColumns(["sales", "units"])
+    for title, (sales, units) in VALUES.items():
+        grouped.add_result(make_result(title, sales, units))
+    return grouped
+
+
+def test_each_measure_keeps_its_own_top_groups():
+    columns = make_grouped().to_columns(top=2)
+
+    assert columns["sales"].dimension_values == ["g0", "g1"]
+    assert list(columns["sales"].values) == [5, 5, 4, 4]
+    assert columns["units"].dimension_values == ["g4", "g3"]
+    assert list(columns["units"].values) == [5, 5, 4, 4]
+
+
+def test_every_group_without_top():
+    columns = make_grouped().to_columns()
+
+    assert columns["units"].dimension_values == list(VALUES)
+    assert len(columns["units"]) == 2 * len(VALUES)
+
+
+def test_parse():
+    body = {
+        "results": [
+            make_result(title, sales, units) for title, (sales, units) in VALUES.items()
+        ]
+    }
+    grouped = GroupedColumns.parse(io.BytesIO(json.dumps(body).encode()), ["units"])
+
+    assert len(grouped) == len(VALUES)
+    assert list(grouped.to_columns(top=1)["units"].values) == [5, 5]
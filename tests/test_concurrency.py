@@ -0,0 +1,142 @@
+import asyncio
+import threading
+
+import pytest
+
+from analytics.concurrency import AdaptiveLimiter
+
+
+async def settle():
+    # Lets granted waiters, scheduled with call_soon_threadsafe, run
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def test_acquire_waits_for_release():
+    limiter = AdaptiveLimiter("test", initial=2, maximum=4)
+    await limiter.acquire()
+    await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    await settle()
+    assert not waiter.done()
+    assert limiter.in_flight == 2
+
+    limiter.release()
+    await settle()
+    assert waiter.done()
+    assert limiter.in_flight == 2
+
+
+async def test_waiters_are_granted_in_order():
+    limiter = AdaptiveLimiter("test", initial=1, maximum=1)
+    await limiter.acquire()
+    granted = []
+
+    async def acquire(name):
+        await limiter.acquire()
+        granted.append(name)
+
+    tasks = [asyncio.create_task(acquire(name)) for name in ("a", "b")]
+    await settle()
+    limiter.release()
+    await settle()
+    assert granted == ["a"]
+
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert granted == ["a", "b"]
+
+
+async def test_cancelled_waiter_leaves_queue():
+    limiter = AdaptiveLimiter("test", initial=1, maximum=1)
+    await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    await settle()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    assert not limiter.waiters
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+async def test_slot_granted_to_cancelled_waiter_is_released():
+    limiter = AdaptiveLimiter("test", initial=1, maximum=1)
+    await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    await settle()
+    # The slot is handed over, then the wait is cancelled before it resumes
+    limiter.release()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    await settle()
+
+    assert limiter.in_flight == 0
+    assert not limiter.waiters
+
+
+async def test_release_wakes_waiter_on_another_loop():
+    limiter = AdaptiveLimiter("test", initial=1, maximum=1)
+    await limiter.acquire()
+    waiting = threading.Event()
+
+    def acquire_on_thread():
+        async def acquire():
+            task = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            waiting.set()
+            await task
+
+        asyncio.run(acquire())
+
+    thread = threading.Thread(target=acquire_on_thread)
+    thread.start()
+    await asyncio.to_thread(waiting.wait)
+    limiter.release()
+    await asyncio.to_thread(thread.join, 5)
+
+    assert not thread.is_alive()
+    assert limiter.in_flight == 1
+
+
+def test_succeed_grows_limit_up_to_maximum():
+    limiter = AdaptiveLimiter("test", initial=2, maximum=3)
+    limiter.succeed()
+    assert limiter.limit == 2.5
+
+    for _ in range(10):
+        limiter.succeed()
+    assert limiter.limit == 3
+
+
+def test_throttle_backs_off_once_per_cooldown():
+    limiter = AdaptiveLimiter("test", initial=8, maximum=8, minimum=3, cooldown=60)
+    limiter.throttle()
+    limiter.throttle()
+    assert limiter.limit == 4
+
+    limiter.last_decrease = float("-inf")
+    limiter.throttle()
+    assert limiter.limit == 3
+
+
+async def test_throttle_holds_back_waiters():
+    limiter = AdaptiveLimiter("test", initial=2, maximum=2)
+    await limiter.acquire()
+    await limiter.acquire()
+    limiter.throttle()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    limiter.release()
+    await settle()
+    # One call is still in flight, which the reduced limit allows
+    assert not waiter.done()
+
+    limiter.release()
+    await settle()
+    assert waiter.done()
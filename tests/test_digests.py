@@ -0,0 +1,142 @@
+from datetime import date
+
+import pyarrow as pa
+import pytest
+
+from analytics.digests import DigestStore, get_slice_digests
+from analytics.stores import FileJsonStore
+
+TABLE_NAME = "units_source"
+
+
+def make_table(rows: list) -> pa.Table:
+    return pa.table(
+        {
+            "date": pa.array([row[0] for row in rows], pa.date32()),
+            "app_name": [row[1] for row in rows],
+            "source": [row[2] for row in rows],
+            "units": [row[3] for row in rows],
+        }
+    )
+
+
+ROWS = [
+    (date(2024, 1, 1), "app", "search", 1),
+    (date(2024, 1, 1), "app", "web", 2),
+    (date(2024, 1, 1), "other", "search", 3),
+    (date(2024, 1, 2), "app", "search", 4),
+]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DigestStore(FileJsonStore(tmp_path / "digests.json"), retention_days=2)
+
+
+async def reload(store: DigestStore) -> DigestStore:
+    await store.save()
+    loaded = DigestStore(store.store, store.retention_days)
+    await loaded.load()
+    return loaded
+
+
+def test_digests_do_not_depend_on_row_order():
+    digests = get_slice_digests(make_table(ROWS))
+
+    assert list(digests) == ["2024-01-01/app", "2024-01-01/other", "2024-01-02/app"]
+    assert get_slice_digests(make_table(ROWS[::-1])) == digests
+
+
+def test_digests_change_with_values():
+    rows = [ROWS[0], ROWS[1][:3] + (None,), *ROWS[2:]]
+    digests = get_slice_digests(make_table(ROWS))
+    changed = get_slice_digests(make_table(rows))
+
+    assert [key for key in digests if digests[key] != changed[key]] == [
+        "2024-01-01/app"
+    ]
+
+
+def test_select_changed_skips_unchanged_slices(store):
+    table, digests = store.select_changed(TABLE_NAME, make_table(ROWS))
+    assert table.num_rows == len(ROWS)
+    store.record(TABLE_NAME, digests)
+
+    table, digests = store.select_changed(TABLE_NAME, make_table(ROWS[::-1]))
+    assert table.num_rows == 0
+    assert digests == {}
+
+
+def test_select_changed_writes_changed_slices_alone(store):
+    # Slices of the other apps of a date are not rewritten with the changed one
+    store.record(TABLE_NAME, get_slice_digests(make_table(ROWS)))
+    rows = [*ROWS[:2], ROWS[2][:3] + (30,), ROWS[3]]
+
+    table, digests = store.select_changed(TABLE_NAME, make_table(rows))
+
+    assert list(digests) == ["2024-01-01/other"]
+    assert table["units"].to_pylist() == [30]
+
+
+def test_select_changed_without_skipping(store):
+    store.record(TABLE_NAME, get_slice_digests(make_table(ROWS)))
+    store.start_run(skip_unchanged=False)
+
+    table, digests = store.select_changed(TABLE_NAME, make_table(ROWS))
+
+    assert table.num_rows == len(ROWS)
+    assert len(digests) == 3
+
+
+async def test_pending_dates_survive_until_cleared(store):
+    await store.load()
+    store.record(TABLE_NAME, get_slice_digests(make_table(ROWS)))
+
+    store = await reload(store)
+    assert store.get_pending() == {TABLE_NAME: {date(2024, 1, 1), date(2024, 1, 2)}}
+    assert store.get_pending(date(2024, 1, 2)) == {TABLE_NAME: {date(2024, 1, 2)}}
+
+    # A failed transformation does not clear its dates
+    store.clear_pending({TABLE_NAME: {date(2024, 1, 1)}})
+    store = await reload(store)
+    assert store.get_pending() == {TABLE_NAME: {date(2024, 1, 2)}}
+
+    store.clear_pending(store.get_pending())
+    store = await reload(store)
+    assert store.get_pending() == {}
+
+
+async def test_save_prunes_digests_past_retention(store):
+    await store.load()
+    rows = [(date(2024, 1, n), "app", "search", n) for n in range(1, 6)]
+    store.record(TABLE_NAME, get_slice_digests(make_table(rows)))
+
+    store = await reload(store)
+
+    assert sorted(store.digests[TABLE_NAME]) == [
+        "2024-01-03/app",
+        "2024-01-04/app",
+        "2024-01-05/app",
+    ]
+
+
+def test_record_tracks_shard_digests(store):
+    digests = get_slice_digests(make_table(ROWS))
+    store.record(TABLE_NAME, digests)
+    store.start_run(skip_unchanged=True, persist=False)
+    store.record(TABLE_NAME, {"2024-01-02/app": digests["2024-01-02/app"]})
+
+    assert store.get_written() == {
+        TABLE_NAME: {"2024-01-02/app": digests["2024-01-02/app"]}
+    }
+
+
+async def test_save_skipped_without_persist(tmp_path):
+    path = tmp_path / "digests.json"
+    store = DigestStore(FileJsonStore(path), retention_days=2)
+    await store.load()
+    store.start_run(skip_unchanged=True, persist=False)
+    store.record(TABLE_NAME, get_slice_digests(make_table(ROWS)))
+    await store.save()
+
+    assert not path.exists()
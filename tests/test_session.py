@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+from analytics.session import SessionStore
+from analytics.stores import FileJsonStore
+
+
+async def hold_lock(store: SessionStore, held: threading.Barrier):
+    lock = store.get_lock()
+    assert store.get_lock() is lock
+    async with lock:
+        # Both loops hold their lock at once
+        await asyncio.to_thread(held.wait, 5)
+    return lock
+
+
+def test_each_loop_has_its_own_lock(tmp_path):
+    store = SessionStore(FileJsonStore(tmp_path / "session.json"))
+    held = threading.Barrier(2)
+    locks = []
+    threads = [
+        threading.Thread(
+            target=lambda: locks.append(asyncio.run(hold_lock(store, held)))
+        )
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(locks) == 2
+    assert locks[0] is not locks[1]
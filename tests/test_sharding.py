@@ -0,0 +1,138 @@
+from datetime import date, datetime
+
+import pytest
+
+from analytics import sharding
+from analytics.digests import DigestStore
+from analytics.metrics import RUN, metrics
+from analytics.stores import FileJsonStore
+from analytics.watermarks import WatermarkStore
+
+START = datetime(2024, 1, 1)
+END = datetime(2024, 1, 10)
+# Expected rows per day of each dimension of app 1
+ROWS_PER_DAY = {"source": 10, "territory": 8, "device": 6, "version": 4}
+DIMENSIONS = list(ROWS_PER_DAY)
+
+
+@pytest.fixture
+def watermark_store(tmp_path):
+    store = WatermarkStore(FileJsonStore(tmp_path / "watermarks.json"))
+    for dimension, rows in ROWS_PER_DAY.items():
+        key = store.make_key("1", "units", dimension)
+        store.record(key, date(2023, 12, 1), date(2023, 12, 1), rows)
+    return store
+
+
+@pytest.fixture
+def digest_store(tmp_path):
+    return DigestStore(FileJsonStore(tmp_path / "digests.json"), retention_days=30)
+
+
+def plan_export(app_id, start_date, end_date) -> dict:
+    return {("units", dimension): [(start_date, end_date)] for dimension in DIMENSIONS}
+
+
+def plan(watermark_store, apps, shards: int, window_days: int = 10) -> list:
+    return sharding.plan_shards(
+        apps, START, END, shards, window_days, plan_export, watermark_store, 1
+    )
+
+
+def test_plan_balances_expected_rows(watermark_store):
+    shard_units = plan(watermark_store, [("1", "App")], shards=2)
+
+    # 10 + 4 and 8 + 6 rows per day, each shard's dimensions in one unit
+    assert shard_units == [
+        [sharding.make_unit("1", "App", START, END, ["source", "version"])],
+        [sharding.make_unit("1", "App", START, END, ["territory", "device"])],
+    ]
+
+
+def test_plan_weighs_apps_without_watermarks_by_default(watermark_store):
+    shard_units = plan(watermark_store, [("1", "App"), ("2", "New")], shards=2)
+
+    # App 2 is expected to write 1 row per day of each dimension, so both
+    # shards expect 160 rows
+    assert [
+        [(unit["app_id"], unit["dimensions"]) for unit in units]
+        for units in shard_units
+    ] == [
+        [("1", ["source", "version"]), ("2", ["source", "device"])],
+        [("1", ["territory", "device"]), ("2", ["territory", "version"])],
+    ]
+
+
+def test_plan_splits_windows(watermark_store):
+    shard_units = plan(watermark_store, [("1", "App")], shards=2, window_days=5)
+
+    assert shard_units == [
+        [sharding.make_unit("1", "App", START, datetime(2024, 1, 5), DIMENSIONS)],
+        [sharding.make_unit("1", "App", datetime(2024, 1, 6), END, DIMENSIONS)],
+    ]
+
+
+def test_plan_returns_fewer_shards_than_units(watermark_store):
+    shard_units = plan(watermark_store, [("1", "App")], shards=10)
+
+    assert [units[0]["dimensions"] for units in shard_units] == [
+        [dimension] for dimension in DIMENSIONS
+    ]
+
+
+def test_plan_without_units(watermark_store):
+    shard_units = sharding.plan_shards(
+        [("1", "App")], START, END, 2, 10, lambda *args: {}, watermark_store, 1
+    )
+
+    assert shard_units == []
+
+
+def make_result(shard: int) -> dict:
+    key = WatermarkStore.make_key("1", "units", f"dimension-{shard}")
+    return {
+        "failures": {},
+        "watermarks": [[key, "2024-01-01", "2024-01-10", 10 * (shard + 1)]],
+        "digests": {"units_source": {f"2024-01-0{shard + 1}/App": f"digest-{shard}"}},
+        "metrics": {"timings": [], "counters": [[RUN, "slices_written", 1]]},
+    }
+
+
+async def test_export_shards_merges_every_shard(
+    monkeypatch, watermark_store, digest_store
+):
+    async def run_shard_deployment(deployment, shard, units, options):
+        if shard == 2:
+            raise RuntimeError("crashed")
+        return make_result(shard)
+
+    monkeypatch.setattr(sharding, "run_shard_deployment", run_shard_deployment)
+    metrics.reset()
+
+    failures = await sharding.export_shards(
+        [[], [], []], "deployment", "export", {}, watermark_store, digest_store
+    )
+
+    assert failures == {"shard-2": "RuntimeError('crashed')"}
+    for shard in (0, 1):
+        key = WatermarkStore.make_key("1", "units", f"dimension-{shard}")
+        assert watermark_store.get(key)["rows_per_day"] == shard + 1
+    assert digest_store.digests == {
+        "units_source": {"2024-01-01/App": "digest-0", "2024-01-02/App": "digest-1"}
+    }
+    assert digest_store.get_pending() == {
+        "units_source": {date(2024, 1, 1), date(2024, 1, 2)}
+    }
+    assert metrics.counters[(RUN, "slices_written")] == 2
+    # The merged stores are saved by the parent run
+    assert await watermark_store.store.read() is not None
+    assert (await digest_store.store.read())["digests"] == digest_store.digests
+
+
+def test_merge_shard_returns_failures(watermark_store, digest_store):
+    result = make_result(0)
+    result["failures"] = {"App": "timed out"}
+
+    assert sharding.merge_shard(result, watermark_store, digest_store) == {
+        "App": "timed out"
+    }
@@ -0,0 +1,91 @@
+from datetime import date, datetime
+
+import pytest
+
+from analytics.stores import FileJsonStore
+from analytics.watermarks import WatermarkStore
+
+KEY = WatermarkStore.make_key("1", "units", "source")
+# Far enough in the future that no date is restated
+RESTATE_FROM = datetime(2030, 1, 1)
+
+
+def day(month, day_of_month) -> datetime:
+    return datetime(2024, month, day_of_month)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return WatermarkStore(FileJsonStore(tmp_path / "watermarks.json"))
+
+
+def test_plan_without_watermark(store):
+    assert store.plan(KEY, day(1, 1), day(1, 31), RESTATE_FROM) == [
+        (day(1, 1), day(1, 31))
+    ]
+
+
+def test_plan_outside_loaded_range(store):
+    store.record(KEY, day(1, 10), day(1, 20), 11)
+
+    assert store.plan(KEY, day(1, 12), day(1, 18), RESTATE_FROM) == []
+    assert store.plan(KEY, day(1, 1), day(1, 31), RESTATE_FROM) == [
+        (day(1, 1), day(1, 9)),
+        (day(1, 21), day(1, 31)),
+    ]
+
+
+def test_plan_restates_recent_dates(store):
+    store.record(KEY, day(1, 1), day(1, 31), 31)
+
+    assert store.plan(KEY, day(1, 1), day(1, 31), day(1, 29)) == [
+        (day(1, 29), day(1, 31))
+    ]
+
+
+def test_record_extends_touching_range(store):
+    store.record(KEY, day(1, 1), day(1, 10), 10)
+    store.record(KEY, day(1, 11), day(1, 15), 10)
+
+    assert store.get(KEY)["ranges"] == [["2024-01-01", "2024-01-15"]]
+    assert store.get(KEY)["rows_per_day"] == 2
+
+
+def test_record_keeps_disjoint_ranges(store):
+    store.record(KEY, day(1, 1), day(1, 31), 31)
+    store.record(KEY, day(3, 1), day(3, 5), 5)
+
+    assert store.get(KEY)["ranges"] == [
+        ["2024-01-01", "2024-01-31"],
+        ["2024-03-01", "2024-03-05"],
+    ]
+    # Only the gap is exported again, not January
+    assert store.plan(KEY, day(1, 1), day(3, 5), RESTATE_FROM) == [
+        (day(2, 1), day(2, 29))
+    ]
+
+
+def test_record_bridges_ranges(store):
+    store.record(KEY, day(1, 1), day(1, 31), 31)
+    store.record(KEY, day(3, 1), day(3, 5), 5)
+    store.record(KEY, day(2, 1), day(2, 29), 29)
+
+    assert store.get(KEY)["ranges"] == [["2024-01-01", "2024-03-05"]]
+
+
+def test_record_tracks_shard_ranges(store):
+    store.start_run(persist=False)
+    store.record(KEY, date(2024, 1, 1), date(2024, 1, 2), 4)
+
+    assert store.recorded == [(KEY, "2024-01-01", "2024-01-02", 4)]
+
+
+async def test_save_skipped_without_persist(tmp_path):
+    path = tmp_path / "watermarks.json"
+    store = WatermarkStore(FileJsonStore(path))
+    await store.load()
+    store.start_run(persist=False)
+    store.record(KEY, day(1, 1), day(1, 1), 1)
+    await store.save()
+
+    assert not path.exists()
@@ -0,0 +1,111 @@
+import pyarrow as pa
+import pytest
+
+from analytics.writer import CoalescingWriter
+
+MEASURE = "units"
+DIMENSION = "source"
+
+
+class FakeClient:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        # Rows of each write
+        self.writes = []
+
+    async def create_table_if_not_exists(self, measure, dimension):
+        pass
+
+    async def write_table(self, measure, dimension, table, overwrite=True):
+        if self.fail:
+            raise RuntimeError("load failed")
+        self.writes.append(table.num_rows)
+
+
+def make_table(rows: int) -> pa.Table:
+    return pa.table({"value": list(range(rows))})
+
+
+def create_writer(client, max_rows=100, max_delay=60):
+    async def create_client():
+        return client
+
+    return CoalescingWriter(create_client, max_rows=max_rows, max_delay=max_delay)
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+async def test_flushes_once_every_producer_is_done(client):
+    writer = create_writer(client)
+    writer.register(MEASURE, DIMENSION, producers=2)
+    flushed = []
+
+    await writer.write(MEASURE, DIMENSION, "a", make_table(3))
+    await writer.done(MEASURE, DIMENSION, "a", on_flushed=lambda: flushed.append("a"))
+    assert client.writes == []
+    assert flushed == []
+
+    await writer.write(MEASURE, DIMENSION, "b", make_table(2))
+    await writer.done(MEASURE, DIMENSION, "b", on_flushed=lambda: flushed.append("b"))
+    assert client.writes == [5]
+    assert sorted(flushed) == ["a", "b"]
+
+
+async def test_flushes_full_buffer_before_producers_are_done(client):
+    writer = create_writer(client, max_rows=4)
+    writer.register(MEASURE, DIMENSION, producers=2)
+    flushed = []
+
+    await writer.write(MEASURE, DIMENSION, "a", make_table(3))
+    await writer.write(MEASURE, DIMENSION, "b", make_table(2))
+    assert client.writes == [5]
+
+    # The app's rows are all flushed, so it is called back as it finishes
+    await writer.done(MEASURE, DIMENSION, "a", on_flushed=lambda: flushed.append("a"))
+    assert flushed == ["a"]
+
+    await writer.write(MEASURE, DIMENSION, "b", make_table(1))
+    await writer.done(MEASURE, DIMENSION, "b", on_flushed=lambda: flushed.append("b"))
+    assert client.writes == [5, 1]
+    assert flushed == ["a", "b"]
+
+
+async def test_producer_without_rows_is_called_back(client):
+    writer = create_writer(client)
+    writer.register(MEASURE, DIMENSION)
+    flushed = []
+
+    await writer.write(MEASURE, DIMENSION, "a", make_table(0))
+    await writer.done(MEASURE, DIMENSION, "a", on_flushed=lambda: flushed.append("a"))
+    assert client.writes == []
+    assert flushed == ["a"]
+
+
+async def test_failed_flush_is_not_called_back():
+    writer = create_writer(FakeClient(fail=True), max_rows=2)
+    writer.register(MEASURE, DIMENSION)
+    flushed = []
+
+    await writer.write(MEASURE, DIMENSION, "a", make_table(2))
+    await writer.write(MEASURE, DIMENSION, "a", make_table(1))
+    await writer.done(MEASURE, DIMENSION, "a", on_flushed=lambda: flushed.append("a"))
+
+    assert flushed == []
+    assert list(writer.failures) == [f"a/{MEASURE}/{DIMENSION}"]
+    assert writer.buffers[(MEASURE, DIMENSION)].pending["a"] == 0
+
+
+async def test_flush_expired(client):
+    writer = create_writer(client, max_delay=0)
+    writer.register(MEASURE, DIMENSION)
+
+    await writer.write(MEASURE, DIMENSION, "a", make_table(2))
+    await writer.flush_expired()
+    assert client.writes == [2]
+
+    # Nothing is buffered any more
+    await writer.flush_all()
+    assert client.writes == [2]
@@ -0,0 +1,46 @@
+{% macro submission_start_date() -%}
+  {{ var("submission_date") }}
+{%- endmacro %}
+
+{% macro submission_end_date() -%}
+  {{ var("submission_end_date", var("submission_date")) }}
+{%- endmacro %}
+
+{# Dates to transform: the submission_dates var when the run lists the dates that changed, otherwise every date from submission_date to submission_end_date #}
+{% macro submission_dates() %}
+  {# The date vars are only passed to runs, not when the project is parsed #}
+  {% if not execute %}
+    {{ return([]) }}
+  {% endif %}
+  {% set dates = var("submission_dates", none) %}
+  {% if dates is none %}
+    {% set start = modules.datetime.date.fromisoformat(submission_start_date() | trim) %}
+    {% set end = modules.datetime.date.fromisoformat(submission_end_date() | trim) %}
+    {% set dates = [] %}
+    {% for day in range((end - start).days + 1) %}
+      {% do dates.append((start + modules.datetime.timedelta(days=day)).isoformat()) %}
+    {% endfor %}
+  {% endif %}
+  {{ return(dates) }}
+{% endmacro %}
+
+{# Restricts a partitioned source relation to the submitted dates so only those partitions are scanned #}
+{% macro submission_source(relation) -%}
+  (
+    SELECT
+      *
+    FROM
+      {{ relation }}
+    WHERE
+      date IN ({{ submission_partitions() | join(", ") }})
+  )
+{%- endmacro %}
+
+{# Literals of the submitted dates, to filter date partitions by #}
+{% macro submission_partitions() %}
+  {% set partitions = [] %}
+  {% for day in submission_dates() %}
+    {% do partitions.append("DATE '" ~ day ~ "'") %}
+  {% endfor %}
+  {{ return(partitions) }}
+{% endmacro %}
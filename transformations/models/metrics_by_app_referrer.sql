@@ -1,3 +1,29 @@
+{{ config(cluster_by=["app_name", "app_referrer"]) }}
+
+{% if var("export_layout", "measure") == "wide" %}
+
+SELECT
+  date,
+  app_name,
+  app_referrer,
+  app_units,
+  iap,
+  impressions,
+  impressions_unique_device,
+  paying_users,
+  product_page_views,
+  product_page_views_unique_device,
+  sales,
+  active_devices_opt_in,
+  active_devices_last_30_days_opt_in,
+  deletions_opt_in,
+  installations_opt_in,
+  sessions_opt_in
+FROM
+  {{ submission_source(source("apple_app_store_exported", "all_metrics_by_app_referrer")) }}
+
+{% else %}
+
 SELECT
   * EXCEPT (active_devices, active_devices_last_30_days, deletions, installations, sessions),
   active_devices AS active_devices_opt_in,
@@ -6,54 +32,54 @@ SELECT
   installations AS installations_opt_in,
   sessions AS sessions_opt_in
 FROM
-  `apple_app_store_exported.active_devices_by_opt_in_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "active_devices_by_opt_in_app_referrer")) }}
 FULL JOIN
-  `apple_app_store_exported.active_devices_last_30_days_by_opt_in_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "active_devices_last_30_days_by_opt_in_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.app_units_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "app_units_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.deletions_by_opt_in_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "deletions_by_opt_in_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.iap_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "iap_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.impressions_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "impressions_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.impressions_unique_device_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "impressions_unique_device_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.installations_by_opt_in_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "installations_by_opt_in_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.paying_users_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "paying_users_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.product_page_views_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "product_page_views_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.product_page_views_unique_device_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "product_page_views_unique_device_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.sales_by_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "sales_by_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
 FULL JOIN
-  `apple_app_store_exported.sessions_by_opt_in_app_referrer`
+  {{ submission_source(source("apple_app_store_exported", "sessions_by_opt_in_app_referrer")) }}
 USING
   (date, app_name, app_referrer)
-WHERE
-  date = '{{ var("submission_date") }}'
\ No newline at end of file
+
+{% endif %}